@@ -0,0 +1,178 @@
+from core import *
+import time
+import subprocess
+import json
+import sys
+import random
+import itertools
+import statistics
+import multiprocessing
+from pathlib import Path
+
+DEFAULT_WORKLOAD = dict(
+    n_ops=20000,  # requests sent in total, split evenly between the clients
+    read_ratio=0.9,  # fraction of the requests that are gets, the rest are sets
+    n_keys=10000,  # size of the keyspace, every key is set before the run
+    key_dist="uniform",  # "uniform", or "zipf" to make a few keys much more popular than the rest
+    value_sizes=(16, 16),  # smallest and largest value size (in bytes)
+    value_dist="uniform",  # "uniform", or "zipf" to make small values much more common than large ones
+    zipf_s=0.99,  # exponent of the zipf distributions
+    concurrency=4,  # number of clients, each in its own process with its own connection
+    binary=False,  # whether the clients speak the binary protocol
+    seed=0,
+    output=None,  # path of the JSON report, if any
+)
+
+
+def sampler(n: int, dist: str, zipf_s: float, rng: random.Random):
+    """
+    Return a function that draws a rank in range(n), either uniformly or from a zipf distribution (rank 0 being the most likely).
+    """
+    if dist == "uniform":
+        return lambda: rng.randrange(n)
+    assert dist == "zipf", ValueError(
+        f"Distribution must be 'uniform' or 'zipf', not {dist!r}")
+    cum_weights = list(itertools.accumulate(
+        1 / (rank + 1)**zipf_s for rank in range(n)))
+    population = range(n)
+    return lambda: rng.choices(population, cum_weights=cum_weights)[0]
+
+
+def key_for(rank: int) -> bytes:
+    return b"key%d" % rank
+
+
+def run_client(args: tuple) -> dict:
+    """
+    Send one client's share of the workload and time every request. Run in a worker process.
+    Return the latencies (in seconds) of the gets and sets, and the wall-clock time the client started and finished.
+    """
+    client_id, n_ops, workload, HOST, PORT = args
+    rng = random.Random(workload["seed"] + client_id)
+    next_key = sampler(workload["n_keys"], workload["key_dist"], workload["zipf_s"], rng)
+    min_size, max_size = workload["value_sizes"]
+    next_size = sampler(max_size - min_size + 1,
+                        workload["value_dist"], workload["zipf_s"], rng)
+    payload = rng.randbytes(max_size)
+
+    client = Client(HOST=HOST, PORT=PORT, connection_timeout=10,
+                    vocal=False, binary=workload["binary"])
+    latencies = {"get": [], "set": []}
+    start = time.time()
+    for _ in range(n_ops):
+        key = key_for(next_key())
+        if rng.random() < workload["read_ratio"]:
+            t0 = time.perf_counter()
+            client.get(key)
+            latencies["get"].append(time.perf_counter() - t0)
+        else:
+            value = payload[:min_size + next_size()]
+            t0 = time.perf_counter()
+            client.set(key, value)
+            latencies["set"].append(time.perf_counter() - t0)
+    end = time.time()
+    client.close()
+
+    return dict(latencies=latencies, start=start, end=end)
+
+
+def percentile(sorted_times: list, q: float) -> float:
+    """
+    Return the q-th quantile (0 <= q <= 1) of a sorted list, by the nearest-rank method.
+    """
+    return sorted_times[min(len(sorted_times) - 1, int(q * len(sorted_times)))]
+
+
+def summarize(times: list, elapsed: float) -> dict:
+    """
+    Summarize a list of latencies (in seconds) as throughput (requests per second) and latency percentiles (in microseconds).
+    """
+    if not times:
+        return dict(count=0)
+    times = sorted(times)
+    return dict(
+        count=len(times),
+        throughput=len(times) / elapsed,
+        mean_us=statistics.mean(times) * 1e6,
+        p50_us=percentile(times, 0.5) * 1e6,
+        p99_us=percentile(times, 0.99) * 1e6,
+        p999_us=percentile(times, 0.999) * 1e6,
+        max_us=times[-1] * 1e6,
+    )
+
+
+def main(server_info: dict, **workload) -> dict:
+    """
+    Start a fresh server, fill it with every key of the workload, and drive it with concurrent clients.
+    Print and return a report of the throughput and latency percentiles of the gets, the sets, and all requests together.
+
+    Requires the following parameters:
+    - server_info: The arguments of popen_server.py. Any server option (append_only, cache_size, fsync, ...) can be given.
+    - workload: Any of the keys of DEFAULT_WORKLOAD, to override its default.
+    """
+    workload = {**DEFAULT_WORKLOAD, **workload}
+    HOST = server_info["HOST"]
+    PORT = int(server_info["PORT"])
+    kvstore_path = Path(server_info["kvstore_path"])
+    kvstore_path.unlink(missing_ok=True)
+    kvstore_path.with_suffix(".idx").unlink(missing_ok=True)
+
+    # open server
+    server_proc = subprocess.Popen(
+        [sys.executable, "popen_server.py", json.dumps(server_info)], close_fds=True, stdout=subprocess.DEVNULL)
+
+    # every get of the run finds its key
+    min_size, max_size = workload["value_sizes"]
+    loader = Client(HOST=HOST, PORT=PORT, connection_timeout=10, vocal=False)
+    loader.set_many([(key_for(rank), b"v" * min_size)
+                    for rank in range(workload["n_keys"])])
+
+    n_clients = workload["concurrency"]
+    shares = [workload["n_ops"] // n_clients + (i < workload["n_ops"] % n_clients)
+              for i in range(n_clients)]
+    with multiprocessing.Pool(n_clients) as pool:
+        results = pool.map(
+            run_client, [(i, share, workload, HOST, PORT) for i, share in enumerate(shares)])
+
+    loader.close()
+    server_proc.wait()
+
+    elapsed = max(r["end"] for r in results) - min(r["start"] for r in results)
+    latencies = {op: [t for r in results for t in r["latencies"][op]]
+                 for op in ("get", "set")}
+    report = dict(
+        workload=workload,
+        server=server_info,
+        elapsed_s=elapsed,
+        results={
+            **{op: summarize(times, elapsed) for op, times in latencies.items()},
+            "all": summarize(latencies["get"] + latencies["set"], elapsed),
+        },
+    )
+
+    for op, summary in report["results"].items():
+        if not summary["count"]:
+            continue
+        print(f"{op}: {summary['count']} ops, {summary['throughput']:.0f} ops/s, mean {summary['mean_us']:.0f}us, "
+              f"p50 {summary['p50_us']:.0f}us, p99 {summary['p99_us']:.0f}us, p999 {summary['p999_us']:.0f}us, max {summary['max_us']:.0f}us")
+
+    if workload["output"] is not None:
+        Path(workload["output"]).write_text(json.dumps(report, indent=2))
+
+    return report
+
+
+if __name__ == "__main__":
+    # optionally takes a JSON object of workload and server options, e.g. '{"concurrency": 8, "key_dist": "zipf", "fsync": "always", "output": "bench.json"}'
+    options = json.loads(sys.argv[1]) if len(sys.argv) > 1 else {}
+    server_info = dict(
+        HOST="127.0.0.1",
+        PORT=65000,
+        timeout=3,
+        backlog=10,
+        kvstore_path="benchmark.data"
+    )
+    server_info.update(
+        {key: value for key, value in options.items() if key not in DEFAULT_WORKLOAD})
+    main(server_info, **{key: value for key, value in options.items()
+                         if key in DEFAULT_WORKLOAD})
@@ -1,54 +1,179 @@
 """
-This file contains three classes: Server, Client, and KVStore
+This file contains twelve classes: Server, Connection, ValueCache, Metrics, Replicator, Client, ClientPool, HashRing, ShardedClient, ReplicatedClient, RecvBuffer, and KVStore
 
 Server is a class that listens for connections from clients and dispatches requests to the appropriate function.
 
+Connection is a class that holds the per-client state (socket and buffers) of the Server's event loop.
+
+ValueCache is a class that is used by the Server class to keep recently read values in memory, in front of the KVStore.
+
+Metrics is a class that is used by the Server and KVStore classes to count requests and time them, reported by the stats request.
+
+Replicator is a class that is used by a primary Server to stream the sets it applies to replica Servers.
+
 Client is a class that connects to a server and sends requests to the server.
 
+ClientPool is a class that keeps several connected Clients to one server and leases them to threads.
+
+HashRing is a class that maps keys to servers with consistent hashing; ShardedClient uses it to spread keys over several servers.
+
+ReplicatedClient is a class that sends sets to a primary Server and spreads gets over its replicas.
+
+RecvBuffer is a class that is used by the Server and Client classes to receive data from the network into a reusable buffer.
+
 KVStore is a class that is used by the Server class to store key-value pairs. It is a simple file-based key-value store.
 
+rebalance is a function that moves keys between the KVStore files of a cluster after servers are added or removed.
+
+prefix_range is a function that turns a key prefix into the range of keys a scan should cover.
+
 See the docstrings of each class for more information, or the REPORT.pdf for a high-level overview of the project.
 
-7 constants are defined at the top of the file:
+The following constants are defined at the top of the file:
 - END: The end of a message. Only certain processes use this to delimit messages. 
 - END_SIZE: The size of the END constant. 
 - BUF_SIZE: The size (in bytes) of the buffer used to receive data from the network.
-- SLEEPTIME: The amount of time to sleep between before the server or client sends or receives data.
+- IOV_MAX: The most buffers passed to a single vectored system call (os.pwritev, socket.sendmsg).
+- RETRY_DELAY, MAX_RETRY_DELAY: The first and longest delay (in seconds) between attempts to connect to a server. The delay doubles after every failed attempt.
 - INT_SIZE: The size of an integer (in bytes). Used both in messages and in KVStore.
 - INT_ORDER: The byte order of integers. 
 - KEY_SIZE: The size of a key (in bytes). Used both in messages and in KVStore.
-
-INT_SIZE, INT_ORDER, and KEY_SIZE cannot be changed once a KVStore has been created; the layout of the KVStore file is dependent on these constants.
+- GET_HEADER_SIZE: The size (in bytes) of a get request.
+- SET_HEADER_SIZE: The size (in bytes) of the header of a set request, which is followed by the data block.
+- VALUE_HEADER_SIZE: The size (in bytes) of the header of a get response, which is followed by the data block.
+- STATS_REQUEST: The text protocol stats request.
+- SCAN_REQUEST_SIZE: The size (in bytes) of a scan request.
+- STREAM_CHUNK: The number of bytes of a streamed response (see Server.recv_scan) queued at a time.
+- BIN_HEADER: The fixed header of every binary protocol message: magic, opcode, flags, status, key length, value length, request id.
+- BIN_REQUEST_MAGIC, BIN_RESPONSE_MAGIC: The first byte of binary requests and responses. A connection whose first byte is BIN_REQUEST_MAGIC speaks the binary protocol.
+- BIN_OP_*: The opcodes of the binary protocol.
+- BIN_STATUS_*: The statuses of binary protocol responses.
+- COMPRESS_*: The codecs a value can be compressed with, as flags: in the record headers of a KVStore file, and in the flags of binary get requests (the codecs the client accepts) and responses (the codec used).
+- COMPRESSION, CODECS: The codec flag of each codec name, and the stdlib module (compress and decompress) of each codec flag.
+- KVSTORE_MAGIC, KVSTORE_VERSION: The first bytes of a KVStore file, and the version of its layout that they are followed by.
+- KVSTORE_HEADER: The header of a KVStore file, KVSTORE_MAGIC followed by KVSTORE_VERSION. It is followed by a random file id of KVSTORE_ID_SIZE bytes.
+- KVSTORE_DATA_START: The offset of the first record in a KVStore file.
+- RECORD_HEADER: The fixed header of every key-value record in a KVStore file: checksum, codec flag (0 if the value is not compressed), key length, value size,
+  and a checksum of the header itself.
+- SNAPSHOT_MAGIC, SNAPSHOT_HEADER, SNAPSHOT_ENTRY: The layout of a KVStore index snapshot file: a header (magic, version, file id, end of the records covered, dead bytes, number of entries),
+  one entry (key length, offset, size, codec flag) per key, each followed by its key, and a checksum of all of it.
+
+KVSTORE_HEADER, RECORD_HEADER, and the SNAPSHOT_* constants cannot be changed without changing KVSTORE_VERSION; the layout of the KVStore files is dependent on them.
+KVStore files written before KVSTORE_HEADER existed (version 1) are laid out by KEY_SIZE, INT_SIZE, and INT_ORDER, so those are needed to migrate them.
 """
 
 import socket
+import selectors
+import struct
 import time
 from pathlib import Path
 import shutil
+import os
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import queue
+import hashlib
+import itertools
+import bisect
+import heapq
+import zlib
+import lzma
+import fcntl
 
 END = b"\r\n"
 END_SIZE = len(END)
 BUF_SIZE = 4096
-SLEEPTIME = 0.05
+MAX_RESERVE = 2**20
+IOV_MAX = 1024
+RETRY_DELAY = 0.001
+MAX_RETRY_DELAY = 0.5
 INT_SIZE = 4
 KEY_SIZE = 60
 INT_ORDER = "big"
+GET_HEADER_SIZE = len(b"get ") + KEY_SIZE + len(b" ") + END_SIZE
+SET_HEADER_SIZE = len(b"set ") + KEY_SIZE + len(b" ") + INT_SIZE + len(b" ") + END_SIZE
+VALUE_HEADER_SIZE = len(b"VALUE ") + KEY_SIZE + len(b" ") + INT_SIZE + len(b" ") + END_SIZE
+STATS_REQUEST = b"stats " + END
+SCAN_REQUEST_SIZE = len(b"scan ") + KEY_SIZE + len(b" ") + KEY_SIZE + len(b" ") + INT_SIZE + len(b" ") + END_SIZE
+STREAM_CHUNK = 2**16
+BIN_HEADER = struct.Struct("!BBBBHII")
+BIN_REQUEST_MAGIC = 0x80
+BIN_RESPONSE_MAGIC = 0x81
+BIN_OP_GET = 0x00
+BIN_OP_SET = 0x01
+BIN_OP_STATS = 0x10
+BIN_OP_SCAN = 0x11
+BIN_STATUS_OK = 0x00
+BIN_STATUS_NOT_FOUND = 0x01
+BIN_STATUS_INVALID = 0x04
+BIN_STATUS_NOT_STORED = 0x05
+BIN_STATUS_NOT_REPLICATED = 0x86
+BIN_STATUS_UNKNOWN = 0x81
+COMPRESS_ZLIB = 0x01
+COMPRESS_LZMA = 0x02
+COMPRESSION = {"zlib": COMPRESS_ZLIB, "lzma": COMPRESS_LZMA}
+CODECS = {COMPRESS_ZLIB: zlib, COMPRESS_LZMA: lzma}
+KVSTORE_MAGIC = b"KVSTORE"
+KVSTORE_VERSION = 5
+KVSTORE_HEADER = KVSTORE_MAGIC + bytes([KVSTORE_VERSION])
+KVSTORE_ID_SIZE = 8
+KVSTORE_DATA_START = len(KVSTORE_HEADER) + KVSTORE_ID_SIZE
+RECORD_HEADER = struct.Struct("!IBHII")
+SNAPSHOT_MAGIC = b"KVINDEX"
+SNAPSHOT_HEADER = struct.Struct("!7sB8sQQQ")
+SNAPSHOT_ENTRY = struct.Struct("!HQIB")
 
 
 class Server:
     """
     Class that listens for connections from clients and dispatches requests to the appropriate function.
 
+    The server is event-driven: a single selector multiplexes the listening socket and every client connection,
+    so many clients are served at once and a slow client never stalls the others.
+    Each connection keeps its own read and write buffers (see Connection); a request is dispatched only once all of its bytes have arrived.
+
+    Two protocols are spoken, chosen per connection by the first byte the client sends:
+    - text (see Server.dispatch): memcached-style requests with fixed-width keys, kept for compatibility.
+    - binary (see Server.dispatch_binary): every message starts with a fixed BIN_HEADER, so it is framed and parsed in constant time.
+
+    Requests, bytes, connections, and the time spent in each type of request and in the kvstore are recorded in self.metrics (see Metrics),
+    and reported by the stats request (see Server.recv_stats).
+
+    A shared server is one of several worker processes on the same machine (see popen_server.py, workers), so that requests are parsed and dispatched on every core.
+    Every worker binds the same port with SO_REUSEPORT, and the kernel spreads the incoming connections over them.
+    They share the kvstore file in its shared mode (see KVStore), so a set made through one worker is seen by the gets of every other.
+    Each worker keeps its own metrics, so a stats request reports those of the worker that serves the connection.
+    A worker's cache would miss the sets made through the others, so a shared server has none.
+
+    With compression, large values are compressed once, when they are set, and stored and cached compressed (see KVStore).
+    A binary client that asks for compressed values (see Client, decompress) receives them as they are stored and decompresses them itself;
+    every other client receives them decompressed by the server.
+
     Requires the following parameters:
     - HOST: The IP address of the server.
     - PORT: The port that the server listens on.
-    - timeout: The number of seconds to wait for a client connection before timing out.
+    - timeout: The number of seconds to wait without any connected client before timing out.
     - backlog: The number of queued connections allowed before refusing new connections.
     - kvstore_path: The path to the file used to store key-value pairs.
     - vocal: Whether to print information about the server's state to the console.
+    - append_only: Whether the kvstore appends updates instead of rewriting its file (see KVStore).
+    - compaction_threshold: The fraction of dead bytes at which an append-only kvstore is compacted.
+    - cache_size: The number of bytes of recently read values to keep in memory (see ValueCache). 0 disables the cache.
+    - replicas: The (HOST, PORT) tuples of replica Servers. If given, this server is a primary and streams every successful set to them (see Replicator).
+    - replication: "async" to acknowledge sets before the replicas have applied them, or "sync" to wait for every replica first.
+      In "sync" mode, a set that is stored but that some replica did not store is answered b"NOT REPLICATED {END}" (BIN_STATUS_NOT_REPLICATED):
+      the primary keeps and serves it, only the replicas may miss it. The replicas are waited for in the event loop,
+      so every client waits on the slowest replica; that is the cost of sync mode. A replica that is down is skipped until it is reconnected (see Replicator).
+    - fsync: When the kvstore fsyncs its file: "always", "never", or every so many milliseconds (see KVStore).
+    - shared: Whether other worker processes serve the same port and kvstore file.
+    - compression: The codec values are compressed with, "zlib" or "lzma", or None to store them as they are.
+    - compression_min_bytes: Values smaller than this many bytes are never compressed.
     """
 
-    def __init__(self, HOST: int | str, PORT: int, timeout: int, backlog: int, kvstore_path: str, vocal: bool = True) -> None:
+    def __init__(self, HOST: int | str, PORT: int, timeout: int, backlog: int, kvstore_path: str, vocal: bool = True, append_only: bool = False, compaction_threshold: float = 0.5, cache_size: int = 0, replicas: list | None = None, replication: str = "async", fsync: str | int = "never", shared: bool = False, compression: str | None = None, compression_min_bytes: int = 2**10) -> None:
+        assert not (shared and cache_size), ValueError(
+            "A shared server cannot have a cache, it would miss the sets made through the other workers")
         self.HOST = HOST
         self.PORT = PORT
         self.timeout = timeout
@@ -57,75 +182,397 @@ class Server:
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # allow reuse of socket
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if shared:  # every worker listens on the port
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.s.bind((self.HOST, self.PORT))
-        self.s.settimeout(self.timeout)
-        self.kvstore = KVStore(kvstore_path)  # initialize kvstore
-        self.conn = None  # initialized in self.listen()
-        self.addr = None  # initialized in self.listen()
+        # the selector decides when to accept, so the listening socket never blocks
+        self.s.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.metrics = Metrics()
+        self.kvstore = KVStore(
+            kvstore_path, append_only=append_only, compaction_threshold=compaction_threshold, fsync=fsync, metrics=self.metrics, shared=shared,
+            compression=compression, compression_min_bytes=compression_min_bytes)  # initialize kvstore
+        self.cache = ValueCache(cache_size) if cache_size > 0 else None
+        self.replicator = Replicator(
+            replicas, replication, vocal=vocal) if replicas else None
+        self.connections = {}  # maps client sockets to their Connection
+        self.ready = set()  # connections whose streamed response has ended with requests waiting behind it, dispatched on the next round
+        self.batch_sets = []  # (Connection, position of the reply in its write buffer, key, value) of the stored sets of the round being dispatched
+        self.conn = None  # Connection whose request is being dispatched, set in self._handle_read()
+        self.addr = None  # address of self.conn, set in self._handle_read()
         self.vocal = vocal
 
     def listen(self):
         """
         Main event loop for server. Listens for connections from clients and dispatches requests to the appropriate function.
+        The loop exits once no client has been connected for self.timeout seconds.
         """
         # allow server to accept up to self.backlog connections
         self.s.listen(self.backlog)
+        self.selector.register(self.s, selectors.EVENT_READ)
 
         # main event loop
         while True:
-            # self.conn is a new socket object usable to send and receive data on the connection
-            try:
-                self.conn, self.addr = self.s.accept()
-
-            except TimeoutError as e:
+            # requests left waiting behind a streamed response are dispatched without waiting for the sockets
+            events = self.selector.select(timeout=0 if self.ready else self.timeout)
+            if not events and not self.connections:
                 if self.vocal:
                     print(f"SERVER: Timeout reached at {self.timeout} seconds")
                 break
 
-            # context management for self.conn; closes socket when block is exited or vice versa
-            with self.conn:
-                if self.vocal:
-                    print(f"SERVER: Connected by {self.addr}")
-                fragments = []
-                while True:
-                    # slight delay to allow message time to arrive
-                    time.sleep(SLEEPTIME)
-                    # receive up to BUF_SIZE bytes from client
-                    chunk = self.conn.recv(BUF_SIZE)
-                    fragments.append(chunk)
-                    if END in chunk:  # end of message
-                        self.dispatch(fragments)
-                        fragments = []
-
-                    elif not chunk:  # client disconnected
-                        if self.vocal:
-                            print(f"SERVER: Client disconnected")
-                        break
-
-    def dispatch(self, fragments: list) -> None:
-        """
-        Parse requests from client and dispatch to appropriate function.
-        """
-        # join fragments into a single message and extract request type
-        text_msg = b"".join(fragments)
-        end_loc = text_msg.find(END) - 1
-        msg = text_msg[0:end_loc]
-        req_type = msg[0:3]
+            served = []  # connections whose requests were dispatched in this round
+            # the sets of every connection served in this round are committed together, and only then are their replies sent
+            # the queued sets hold views of the read buffers, so those are not moved until the replies are flushed
+            with self.kvstore.group_commit() as batch:
+                for key, mask in events:
+                    if key.fileobj is self.s:
+                        self._accept()
+                        continue
+
+                    conn = self.connections.get(key.fileobj)
+                    if conn is not None and mask & selectors.EVENT_WRITE:
+                        self._handle_write(conn)
+                    # the connection may have been dropped while writing
+                    if conn is not None and conn.sock in self.connections and mask & selectors.EVENT_READ:
+                        self._handle_read(conn)
+                        served.append(conn)
+
+                ready, self.ready = self.ready, set()
+                for conn in ready:
+                    if conn.sock in self.connections and conn.stream is None:
+                        self._dispatch_requests(conn)
+                        served.append(conn)
+            self._settle_sets(batch["committed"])
+
+            for conn in dict.fromkeys(served):
+                self._flush(conn)
+
+    def _accept(self) -> None:
+        """
+        Accept a pending connection and register it with the selector. Internal method, not to be used directly.
+        """
+        try:
+            sock, addr = self.s.accept()
+        except BlockingIOError:  # the client gave up before we got to it
+            return
+        sock.setblocking(False)
+        # replies are written in one piece, so there is nothing for Nagle's algorithm to coalesce
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[sock] = Connection(sock, addr)
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.metrics.incr("total_connections")
+        if self.vocal:
+            print(f"SERVER: Connected by {addr}")
+
+    def _handle_read(self, conn: "Connection") -> None:
+        """
+        Receive whatever the client has sent and dispatch every complete request in the connection's read buffer.
+        The replies are only queued; they are sent once the round of the event loop has been committed (see Server.listen).
+        Internal method, not to be used directly.
+        """
+        try:
+            # receive as many bytes as fit in the free space of the read buffer
+            nbytes = conn.inbuf.recv_into(conn.sock)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            nbytes = 0
+
+        if not nbytes:  # client disconnected
+            if self.vocal:
+                print(f"SERVER: Client disconnected")
+            self._drop(conn)
+            return
+
+        self.metrics.incr("bytes_read", nbytes)
+        if conn.binary is None:  # first bytes of the connection, negotiate the protocol
+            conn.binary = conn.inbuf.peek(1)[0] == BIN_REQUEST_MAGIC
+        self._dispatch_requests(conn)
+
+    def _dispatch_requests(self, conn: "Connection") -> None:
+        """
+        Dispatch every complete request in the connection's read buffer, and queue the replies. Internal method, not to be used directly.
+        Requests behind a streamed response (see Server.recv_scan) wait in the read buffer until it has been sent in full.
+        """
+        self.conn, self.addr = conn, conn.addr
+        dispatch = self.dispatch_binary if conn.binary else self.dispatch
+        while conn.sock in self.connections and conn.stream is None:
+            request_size = self._request_size(conn.inbuf, conn.binary)
+            if not request_size or request_size > len(conn.inbuf):  # wait for the rest of the request
+                break
+            # the request is dispatched in place, it is only valid until it is consumed
+            dispatch(conn.inbuf.peek(request_size))
+            conn.inbuf.consume(request_size)
+
+    def _flush(self, conn: "Connection") -> None:
+        """
+        Make room in the connection's read buffer for its next request, and send the replies queued for it. Internal method, not to be used directly.
+        Called once the sets of the round are settled (see Server._settle_sets): the consumed bytes of the read buffer are only reclaimed
+        by the reserve, so the values of the batch are valid until then.
+        """
+        if conn.sock not in self.connections:
+            return
+        # make room for all of the next request at once, so a large set is received without reallocating,
+        # but never more than MAX_RESERVE bytes ahead of what has arrived: the size is only what the request claims
+        request_size = self._request_size(conn.inbuf, conn.binary)
+        conn.inbuf.reserve(min(request_size, len(conn.inbuf) + MAX_RESERVE))
+        if conn.outbuf or conn.stream is not None:
+            self._handle_write(conn)
+
+    def _settle_sets(self, committed: bool) -> None:
+        """
+        Replicate the sets of the batch once it is committed, and turn the replies of those that were not committed or not replicated into failures.
+        The replies were queued as stored, and are still in the write buffers, so they are replaced before anything is sent:
+        with NOT STORED if the batch was not committed, and with NOT REPLICATED if it was but the replication failed (the set is kept).
+        Internal method, not to be used directly.
+        """
+        batch_sets, self.batch_sets = self.batch_sets, []
+        for conn, i, key, value in batch_sets:
+            if not committed:
+                status, bin_status = b"NOT STORED " + END, BIN_STATUS_NOT_STORED
+            elif self.replicator is None or self.replicator.replicate(key, value):
+                continue
+            else:
+                status, bin_status = b"NOT REPLICATED " + END, BIN_STATUS_NOT_REPLICATED
+            if conn.sock not in self.connections:  # client already gone
+                continue
+            if conn.binary:
+                header = list(BIN_HEADER.unpack_from(conn.outbuf[i]))
+                header[3] = bin_status
+                conn.outbuf[i] = memoryview(BIN_HEADER.pack(*header))
+            else:
+                conn.outbuf[i] = memoryview(status)
+
+    def _handle_write(self, conn: "Connection") -> None:
+        """
+        Send as much of the connection's write buffer as the socket will take. Internal method, not to be used directly.
+        The queued replies are sent together, up to IOV_MAX of them per system call.
+        A streamed response is queued STREAM_CHUNK bytes at a time, whenever the write buffer runs dry; once it ends, the requests behind it
+        are dispatched by the next round of the event loop (see Server.listen), so that pipelined scans do not nest one call per scan.
+        """
+        streaming = conn.stream is not None
+        try:
+            while conn.outbuf or conn.stream is not None:
+                if not conn.outbuf:
+                    self._fill(conn)
+                    continue
+                sent = conn.sock.sendmsg(itertools.islice(conn.outbuf, IOV_MAX))
+                self.metrics.incr("bytes_written", sent)
+                while conn.outbuf and sent >= len(conn.outbuf[0]):
+                    sent -= len(conn.outbuf.popleft())
+                if sent:  # socket is full
+                    conn.outbuf[0] = conn.outbuf[0][sent:]
+                    break
+        except BlockingIOError:
+            pass
+        except ConnectionError:
+            self._drop(conn)
+            return
+
+        # wait for the socket to be writable only while there is something left to send
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.outbuf else selectors.EVENT_READ
+        self.selector.modify(conn.sock, events)
+        if streaming and conn.stream is None and len(conn.inbuf):
+            self.ready.add(conn)
+
+    def _fill(self, conn: "Connection") -> None:
+        """
+        Queue the next STREAM_CHUNK bytes (or the rest) of the connection's streamed response. Internal method, not to be used directly.
+        """
+        queued = 0
+        while queued < STREAM_CHUNK:
+            part = next(conn.stream, None)
+            if part is None:  # the response is complete
+                conn.stream = None
+                break
+            conn.outbuf.append(memoryview(part))
+            queued += len(part)
+
+    def _send(self, data: bytes) -> None:
+        """
+        Queue data to be sent to the client of self.conn.
+        The connection's write buffer is sent once every request of the round has been dispatched and committed (see Server.listen),
+        and whatever the socket does not take right away is sent by the event loop.
+        """
+        conn = self.conn
+        if conn.sock not in self.connections:  # client already gone
+            return
+        # queued as a view, not copied
+        conn.outbuf.append(memoryview(data))
+
+    def _drop(self, conn: "Connection") -> None:
+        """
+        Unregister and close a connection. Internal method, not to be used directly.
+        """
+        self.selector.unregister(conn.sock)
+        del self.connections[conn.sock]
+        conn.sock.close()
+        if conn.stream is not None:
+            conn.stream.close()
+
+    @staticmethod
+    def _request_size(buf: "RecvBuffer", binary: bool = False) -> int:
+        """
+        Return the size of the first request in buf, or 0 if it has not arrived far enough to tell.
+        The size may be larger than the number of bytes in buf if the rest of the request has not arrived yet.
+
+        Binary requests are a BIN_HEADER followed by the key and value whose lengths it holds.
+
+        Requests have a fixed layout (see Client.get, Client.get_many and Client._set_msg), so their size is known from the request type:
+        get - b"get <key(KEY_SIZE)b> {END}", or b"get <key(KEY_SIZE)b> <key(KEY_SIZE)b> ... {END}" for several keys
+        set - b"set <key(KEY_SIZE)b> <size(INT_SIZE)b> {END}" followed by a data block of size bytes
+        scan - b"scan <start(KEY_SIZE)b> <end(KEY_SIZE)b> <limit(INT_SIZE)b> {END}"
+        Anything else is an invalid request and runs up to the next END.
+        """
+        if binary:
+            if len(buf) < BIN_HEADER.size:
+                return 0
+            *_, key_len, value_len, _ = BIN_HEADER.unpack(buf.peek(BIN_HEADER.size))
+            return BIN_HEADER.size + key_len + value_len
+
+        req_type = bytes(buf.peek(3))
+        match req_type:
+            case b"get":
+                # keys are fixed width, so after each key there is either another key or END
+                request_size = GET_HEADER_SIZE
+                while len(buf) >= request_size and buf.peek(END_SIZE, request_size-END_SIZE) != END:
+                    request_size += KEY_SIZE + 1
+                if len(buf) < request_size:
+                    return 0
+
+            case b"set":
+                if len(buf) < SET_HEADER_SIZE:
+                    return 0
+                size_start = SET_HEADER_SIZE - INT_SIZE - 1 - END_SIZE
+                request_size = SET_HEADER_SIZE + int.from_bytes(
+                    buf.peek(INT_SIZE, size_start), byteorder=INT_ORDER)
+
+            case b"sca":
+                request_size = SCAN_REQUEST_SIZE
+
+            case _:
+                end_loc = buf.find(END)
+                request_size = end_loc + END_SIZE if end_loc != -1 else 0
+
+        return request_size
+
+    def dispatch(self, text_msg: bytes | memoryview) -> None:
+        """
+        Parse a request from client and dispatch to appropriate function.
+        The request may be a memoryview of the connection's read buffer; values are passed on as views of it, without copying.
+        The time taken by every request is recorded in self.metrics, by request type.
+        """
+        start = time.perf_counter()
+        req_type = bytes(text_msg[0:3])
 
         match req_type:
             case b"get":
                 # different from set because we don't need to parse the size of the value
-                req_key = msg[4:end_loc]
-                self.recv_get(req_key)
+                # keys are padded to KEY_SIZE on the wire only, they are stored without the padding
+                req_keys = [bytes(text_msg[key_start:key_start+KEY_SIZE]).rstrip(b" ")
+                            for key_start in range(4, len(text_msg) - END_SIZE, KEY_SIZE + 1)]
+                if len(req_keys) == 1:
+                    self.recv_get(req_keys[0])
+                    name = "cmd_get"
+                else:
+                    self.recv_get_many(req_keys)
+                    name = "cmd_get_many"
 
             case b"set":
-                req_key = msg[4:end_loc-INT_SIZE-1]
-                req_size = int.from_bytes(msg[end_loc-INT_SIZE:end_loc], "big")
-                data_msg_partial = text_msg[end_loc+1+END_SIZE:]
+                req_key = bytes(text_msg[4:4+KEY_SIZE]).rstrip(b" ")
+                size_start = 4 + KEY_SIZE + 1
+                req_size = int.from_bytes(
+                    text_msg[size_start:size_start+INT_SIZE], "big")
+                data_msg_partial = text_msg[SET_HEADER_SIZE:]
                 self.recv_set(req_key, req_size, data_msg_partial)
+                name = "cmd_set"
+
+            case b"sca":
+                start_key = bytes(text_msg[5:5+KEY_SIZE]).rstrip(b" ")
+                end_start = 5 + KEY_SIZE + 1
+                end_key = bytes(text_msg[end_start:end_start+KEY_SIZE]).rstrip(b" ")
+                limit_start = end_start + KEY_SIZE + 1
+                limit = int.from_bytes(
+                    text_msg[limit_start:limit_start+INT_SIZE], byteorder=INT_ORDER)
+                # an empty end key and a limit of 0 mean no bound
+                self.recv_scan(start_key, end_key or None, limit or None)
+                name = "cmd_scan"
+
+            case b"sta" if bytes(text_msg) == STATS_REQUEST:
+                self.recv_stats()
+                name = "cmd_stats"
 
             case _:
-                print(f"SERVER: Invalid request: {msg}")
+                print(f"SERVER: Invalid request: {bytes(text_msg)}")
+                self.metrics.incr("invalid_requests")
+                return
+
+        self.metrics.observe(name, time.perf_counter() - start)
+
+    def dispatch_binary(self, request: bytes | memoryview) -> None:
+        """
+        Parse a binary request from client, execute it, and send a binary response.
+
+        Client sends  - BIN_HEADER(BIN_REQUEST_MAGIC, opcode, flags, 0, key length, value length, request id) <key> <value>
+        Server sends  - BIN_HEADER(BIN_RESPONSE_MAGIC, opcode, flags, status, 0, value length, request id) <value>
+
+        Keys are not padded on the wire, and text protocol keys are stripped of their padding, so both protocols share the same keys.
+        The flags of a get request are the COMPRESS_* codecs the client can decompress, usually none. A value stored compressed with one of them
+        is sent as it is, with its codec in the flags of the response; any other compressed value is decompressed first.
+        A stats request has no key; its response value is the STAT lines of Server.recv_stats, without the END line.
+        A scan request's key is the start key, and its value is the limit (INT_SIZE bytes) followed by the end key (see Server.recv_scan).
+        """
+        start = time.perf_counter()
+        _, opcode, flags, _, key_len, value_len, request_id = BIN_HEADER.unpack_from(
+            request)
+        key = bytes(request[BIN_HEADER.size:BIN_HEADER.size+key_len])
+        value = request[BIN_HEADER.size+key_len:]
+        response_value = b""
+        response_flags = 0
+
+        if opcode == BIN_OP_STATS:
+            status = BIN_STATUS_OK
+            response_value = self._stats_msg()
+
+        elif opcode == BIN_OP_SCAN:
+            limit = int.from_bytes(value[:INT_SIZE], byteorder=INT_ORDER)
+            self.recv_scan(key, bytes(value[INT_SIZE:]) or None, limit or None, request_id)
+            self.metrics.observe("cmd_scan", time.perf_counter() - start)
+            return
+
+        elif not 1 <= key_len <= KEY_SIZE:
+            status = BIN_STATUS_INVALID
+
+        else:
+            key = key.rstrip(b" ")
+            if opcode == BIN_OP_GET:
+                response = self._get(key)
+                if response["value"] is None:
+                    status = BIN_STATUS_NOT_FOUND
+                else:
+                    status = BIN_STATUS_OK
+                    if response["flags"] & flags:  # the client decompresses it
+                        response_value, response_flags = response["value"], response["flags"]
+                    else:
+                        response_value = self._decompressed(response)["value"]
+
+            elif opcode == BIN_OP_SET:
+                stored = self._set(key, value) == b"STORED " + END
+                status = BIN_STATUS_OK if stored else BIN_STATUS_NOT_STORED
+
+            else:
+                if self.vocal:
+                    print(f"SERVER: Invalid binary opcode: {opcode}")
+                status = BIN_STATUS_UNKNOWN
+
+        header = BIN_HEADER.pack(BIN_RESPONSE_MAGIC, opcode, response_flags, status,
+                                 0, len(response_value), request_id)
+        self._send(header + response_value)
+        if status in (BIN_STATUS_INVALID, BIN_STATUS_UNKNOWN):
+            self.metrics.incr("invalid_requests")
+        else:
+            name = {BIN_OP_GET: "cmd_get", BIN_OP_SET: "cmd_set", BIN_OP_STATS: "cmd_stats"}[opcode]
+            self.metrics.observe(name, time.perf_counter() - start)
 
     def recv_get(self, key: bytes) -> None:
         """
@@ -138,101 +585,560 @@ class Server:
         data block - b"<value(size)b> {END}"
         end        - b"END {END}"
         """
-        response = self.kvstore.get(key)
+        response = self._get(key)
         if response["value"] is None:  # key not found
-            time.sleep(SLEEPTIME)
-            self.conn.sendall(b"KEY NOT FOUND " + END)
+            self._send(b"KEY NOT FOUND " + END)
 
         else:
-            # response includes: key, value, size, start_pos, end_pos
-            value, size = response["value"], response["size"]
-            text_msg = b" ".join(
-                (b"VALUE", key, size, END))
-            data_msg = value + b" " + END
+            # the client reads each part by its size, so they can go out together
+            self._send(b"".join((*self._value_msg(response), b"END " + END)))
 
-            time.sleep(SLEEPTIME)
-            self.conn.sendall(text_msg)
+    def recv_get_many(self, keys: list) -> None:
+        """
+        Receive a get request for several keys from client, get each from kvstore, and return them to client in one response.
 
-            time.sleep(SLEEPTIME)
-            self.conn.sendall(data_msg)
+        Keys that are not found are left out of the response, as in memcached.
 
-            time.sleep(SLEEPTIME)
-            self.conn.sendall(b"END " + END)
+        Server sends, for every key found:
+        header     - b"VALUE <key(1-250b)> <size(4b)> {END}"
+        data block - b"<value(size)b> {END}"
+        followed by:
+        end        - b"END {END}"
+        """
+        responses = (self._get(key) for key in keys)
+        parts = [part for response in responses if response["value"] is not None
+                 for part in self._value_msg(response)]
+        self._send(b"".join((*parts, b"END " + END)))
 
-    def recv_set(self, key: bytes, size: int, data_msg_partial: bytes = b"") -> None:
+    def _get(self, key: bytes) -> dict:
         """
-        Upon execution, prepares to receive the data block of a set request from the client. 
-        Once the data block is received, it is passed to the kvstore to be set.
-        The server responds with the status of the kvstore.set operation.
+        Get a key from the cache, falling back to the kvstore (and caching the result) on a miss.
+        Returns the same dictionary as KVStore.get, with the value as it is stored: it may be compressed (see Server._decompressed).
+        """
+        response = self.cache.get(key) if self.cache is not None else None
+        if response is None:
+            start = time.perf_counter()
+            response = self.kvstore.get(key, decompress=False)
+            self.metrics.observe("kvstore_get", time.perf_counter() - start)
+            if self.cache is not None and response["value"] is not None:
+                self.cache.put(key, response)
+
+        self.metrics.incr("get_misses" if response["value"] is None else "get_hits")
+        return response
+
+    @staticmethod
+    def _decompressed(response: dict) -> dict:
         """
-        data = []
-        nbytes = size
-        partial_size = len(data_msg_partial)
-        nbytes -= partial_size
-        data.append(data_msg_partial)
+        Return a kvstore.get response with its value decompressed, if it is compressed. Internal method, not to be used directly.
+        """
+        if not response.get("flags"):
+            return response
+        value = CODECS[response["flags"]].decompress(response["value"])
+        return dict(response, value=value, size=len(value).to_bytes(INT_SIZE, byteorder=INT_ORDER), flags=0)
 
-        while nbytes > 0:
-            partial = self.conn.recv(BUF_SIZE)
-            data.append(partial)
-            nbytes -= len(partial)
+    @staticmethod
+    def _value_msg(response: dict) -> tuple:
+        """
+        Format the header and data block of a kvstore.get response. Internal method, not to be used directly.
+        The parts are returned separately so that the value is only copied once, when the whole response is joined.
+        The text protocol has no flags, so a compressed value is decompressed first.
+        """
+        response = Server._decompressed(response)
+        # response includes: key, value, size, start_pos, end_pos
+        text_msg = b" ".join(
+            (b"VALUE", response["key"].ljust(KEY_SIZE, b" "), response["size"], END))
+        return text_msg, response["value"], b" " + END
 
-            if not partial:
-                print(f"SERVER: Client disconnected")
-                break
+    def recv_set(self, key: bytes, size: int, data_msg: bytes | memoryview) -> None:
+        """
+        Receive the data block of a set request from the client and pass it to the kvstore to be set.
+        The data block has already been read in full into the connection's read buffer by the event loop.
+        The server responds with the status of the kvstore.set operation.
+        """
+        # strip the trailing b" {END}" that terminates the data block
+        value = data_msg[:size - 1 - END_SIZE]
+        self._send(self._set(key, value))
 
-        value = b"".join(data).rstrip(b" " + END)
+    def _set(self, key: bytes, value: bytes | memoryview) -> bytes:
+        """
+        Set a key in the kvstore and drop it from the cache. Returns the same status as KVStore.set.
+        The set is only queued: it is replicated once the batch is committed, and its reply (which must be the next one queued) is changed
+        to a failure if the commit or the replication fails (see Server._settle_sets).
+        """
+        start = time.perf_counter()
         status = self.kvstore.set(key, value, len(
             value).to_bytes(INT_SIZE, byteorder=INT_ORDER))
-        time.sleep(SLEEPTIME)
-        self.conn.sendall(status)
+        self.metrics.observe("kvstore_set", time.perf_counter() - start)
+        if self.cache is not None:  # the cached value is stale, it is read again on the next get
+            self.cache.invalidate(key)
+        if status == b"STORED " + END:
+            self.batch_sets.append((self.conn, len(self.conn.outbuf), key, value))
+        return status
+
+    def recv_scan(self, start: bytes, end: bytes | None, limit: int | None, request_id: int | None = None) -> None:
+        """
+        Receive a scan request from client and stream back the pairs with start <= key < end (no upper bound if end is None),
+        in key order, at most limit of them (no limit if None). See KVStore.scan.
+        The response is produced as the socket drains (see Server._handle_write), so a large scan is never held in memory whole.
+
+        Server sends, for every pair:
+        header     - b"VALUE <key(KEY_SIZE)b> <size(4b)> {END}"
+        data block - b"<value(size)b> {END}"
+        followed by:
+        end        - b"END {END}"
+
+        Over the binary protocol (request_id is given), every pair is a response with status BIN_STATUS_OK carrying the key and value,
+        and the end is a response with status BIN_STATUS_NOT_FOUND and no key or value.
+        """
+        pairs = self.kvstore.scan(start, end, limit)
+
+        def stream():
+            for key, value in pairs:
+                if request_id is None:
+                    yield from self._value_msg(dict(key=key, value=value,
+                                                    size=len(value).to_bytes(INT_SIZE, byteorder=INT_ORDER)))
+                else:
+                    yield BIN_HEADER.pack(BIN_RESPONSE_MAGIC, BIN_OP_SCAN, 0, BIN_STATUS_OK,
+                                          len(key), len(value), request_id) + key
+                    yield value
+            if request_id is None:
+                yield b"END " + END
+            else:
+                yield BIN_HEADER.pack(BIN_RESPONSE_MAGIC, BIN_OP_SCAN, 0, BIN_STATUS_NOT_FOUND, 0, 0, request_id)
+
+        self.conn.stream = stream()
+
+    def recv_stats(self) -> None:
+        """
+        Receive a stats request from client and send every statistic of the server back (see Server.stats), as in memcached.
+
+        Client sends:
+        request - STATS_REQUEST
+
+        Server sends, for every statistic:
+        stat    - b"STAT <name> <value> {END}"
+        followed by:
+        end     - b"END {END}"
+        """
+        self._send(self._stats_msg() + b"END " + END)
+
+    def stats(self) -> dict:
+        """
+        Return the server's statistics: its metrics (see Metrics.stats), its connections, and the state of its cache and kvstore.
+        """
+        stats = dict(pid=os.getpid(), curr_connections=len(self.connections), **self.metrics.stats())
+        if self.cache is not None:
+            stats.update({f"cache_{name}": value for name, value in self.cache.stats().items()})
+        stats.update(kvstore_keys=len(self.kvstore.index), kvstore_bytes=self.kvstore.end_pos,
+                     kvstore_dead_bytes=self.kvstore.dead_bytes)
+        return stats
+
+    def _stats_msg(self) -> bytes:
+        """
+        Format the statistics of the server as STAT lines. Internal method, not to be used directly.
+        """
+        return b"".join(f"STAT {name} {value} ".encode() + END for name, value in self.stats().items())
 
     def close(self):
         """ 
         Terminate the server.
         """
+        for conn in list(self.connections.values()):
+            self._drop(conn)
+        if self.cache is not None and self.vocal:
+            print(f"SERVER: Cache stats {self.cache.stats()}")
+        self.selector.close()
         self.s.close()
+        if self.replicator is not None:
+            self.replicator.close()
+        self.kvstore.close()
+
+
+class Connection:
+    """
+    State kept by the Server for each connected client. Not to be used directly.
+
+    Requires the following parameters:
+    - sock: The (non-blocking) socket of the connection.
+    - addr: The address of the client.
+    """
+
+    def __init__(self, sock: socket.socket, addr: tuple) -> None:
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = RecvBuffer()  # bytes received but not yet dispatched
+        self.outbuf = deque()  # views of the data queued but not yet sent
+        self.binary = None  # whether the client speaks the binary protocol, decided by the first byte it sends
+        self.stream = None  # generator of the rest of a streamed response, see Server.recv_scan
+
+
+class ValueCache:
+    """
+    An in-memory LRU cache of kvstore.get responses, bounded by the total size (in bytes) of the keys and values it holds.
+    When a new response does not fit, the least recently used responses are evicted until it does.
+    Responses larger than the whole cache are never cached.
+    Hits, misses, and evictions are counted so that the cache can be sized (see ValueCache.stats).
+    It is not recommended to use this class directly; it is used by the Server class.
+
+    Requires the following parameters:
+    - max_bytes: The maximum total size of the cached keys and values.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()  # least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: bytes) -> dict | None:
+        """
+        Return the cached response for key, or None if it is not cached.
+        """
+        response = self.entries.get(key)
+        if response is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return response
+
+    def put(self, key: bytes, response: dict) -> None:
+        """
+        Cache the response for key, evicting least recently used responses to make room.
+        """
+        self.invalidate(key)
+        nbytes = len(key) + len(response["value"])
+        if nbytes > self.max_bytes:
+            return
+
+        while self.nbytes + nbytes > self.max_bytes:
+            old_key, old_response = self.entries.popitem(last=False)
+            self.nbytes -= len(old_key) + len(old_response["value"])
+            self.evictions += 1
+
+        self.entries[key] = response
+        self.nbytes += nbytes
+
+    def invalidate(self, key: bytes) -> None:
+        """
+        Drop the cached response for key, if there is one.
+        """
+        response = self.entries.pop(key, None)
+        if response is not None:
+            self.nbytes -= len(key) + len(response["value"])
+
+    def stats(self) -> dict:
+        """
+        Return the cache's counters and current size.
+        """
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    items=len(self.entries), bytes=self.nbytes, max_bytes=self.max_bytes)
+
+
+class Metrics:
+    """
+    Counters and latency histograms, reported by the Server's stats request (see Server.recv_stats).
+    Latencies are counted in buckets of powers of two microseconds, so recording one is a few additions, and percentiles are estimated
+    as the upper bound of the bucket they fall in. Metrics are recorded from the Server's event loop and the KVStore's background threads,
+    so every update is made under a lock.
+    It is not recommended to use this class directly; it is used by the Server and KVStore classes.
+    """
+
+    N_BUCKETS = 40  # bucket i counts latencies below 2^i microseconds (and at least 2^(i-1)), the last one everything longer
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.counters = {}  # name -> count
+        self.histograms = {}  # name -> [bucket counts, total seconds, max seconds]
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, n: int = 1) -> None:
+        """
+        Add n to the counter name.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Record a latency (in seconds) in the histogram name.
+        """
+        bucket = min(int(seconds * 1e6).bit_length(), self.N_BUCKETS - 1)
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * self.N_BUCKETS, 0.0, 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+
+    def stats(self) -> dict:
+        """
+        Return every counter, and for every histogram its count (under its own name) and its mean, p50, p99, p999, and max latency (in microseconds).
+        """
+        with self._lock:
+            stats = dict(uptime=int(time.time() - self.started), **self.counters)
+            for name, (buckets, total, longest) in self.histograms.items():
+                count = sum(buckets)
+                stats[name] = count
+                stats[f"{name}_mean_us"] = round(total / count * 1e6, 1)
+                for label, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+                    rank = q * count
+                    seen = 0
+                    for bucket, n in enumerate(buckets):
+                        seen += n
+                        if seen >= rank:
+                            break
+                    stats[f"{name}_{label}_us"] = min(2**bucket, round(longest * 1e6, 1))
+                stats[f"{name}_max_us"] = round(longest * 1e6, 1)
+        return stats
+
+
+class Replicator:
+    """
+    Streams the sets applied by a primary Server to its replica Servers, as a log of (key, value) records sent over the binary protocol.
+
+    In "async" mode, replicate() queues the record and returns at once; one background thread per replica sends the queued records
+    in pipelined batches, and on a broken connection reconnects and resends the batch until it is acknowledged, backing off between attempts.
+    Replicas therefore lag the primary slightly, but apply the records in the same order.
+    A replica is only connected to when its first record is sent, so a primary starts whether or not its replicas are running.
+    Once the Replicator is closing, a replica that still cannot be reached is given up on: the records queued for it are dropped,
+    and close() waits at most close_timeout seconds for the threads, so an unreachable replica never holds up the Server's shutdown.
+    In "sync" mode, replicate() sends the record to every replica and waits for all of their acknowledgements,
+    so a set is only reported as stored once it is on every replica. It blocks the caller (the Server's event loop) until the slowest replica answers.
+    A replica that fails is marked down and reconnected by a background thread, backing off between attempts;
+    until then replicate() skips it and reports the record as not replicated, so a down replica never costs more than one round trip.
+    It is not recommended to use this class directly; it is used by the Server class.
+
+    Requires the following parameters:
+    - replicas: The (HOST, PORT) tuples of the replica Servers.
+    - mode: "async" or "sync".
+    - batch_size: The largest number of records sent to a replica at once in "async" mode.
+    - vocal: Whether to print information about replication failures to the console.
+    - close_timeout: The number of seconds close() waits for the queued records to be sent.
+    """
+
+    def __init__(self, replicas: list, mode: str = "async", batch_size: int = 1000, vocal: bool = True, close_timeout: float = 5) -> None:
+        assert mode in ("async", "sync"), ValueError(
+            f"Replication mode must be 'async' or 'sync', not: {mode!r}")
+        self.mode = mode
+        self.batch_size = batch_size
+        self.vocal = vocal
+        self.close_timeout = close_timeout
+        self.nodes = [tuple(node) for node in replicas]
+        self.clients = {}  # the connected Client of each replica, see self._client()
+        self.queues = {}
+        self.threads = {}  # the stream thread of each replica in "async" mode, the reconnecting thread of each down replica in "sync" mode
+        self._closing = threading.Event()
+        if mode == "async":
+            for node in self.nodes:
+                self.queues[node] = queue.Queue()
+                self.threads[node] = threading.Thread(
+                    target=self._stream, args=(node,), daemon=True)
+                self.threads[node].start()
+
+    def replicate(self, key: bytes, value: bytes | memoryview) -> bool:
+        """
+        Send a record to every replica. Returns whether it was accepted (queued in "async" mode, stored by every replica in "sync" mode).
+        """
+        # the value may be a view of a receive buffer that is about to be reused
+        value = bytes(value)
+        if self.mode == "async":
+            for q in self.queues.values():
+                q.put((key, value))
+            return True
+
+        # send to every replica before waiting on any, so a set waits for the slowest replica rather than all of them in turn
+        replicated = True
+        sent = []
+        for node in self.nodes:
+            try:
+                client = self._client(node)
+                if client is None:  # down, it misses the record
+                    replicated = False
+                    continue
+                client.s.sendall(client._bin_msg(BIN_OP_SET, key, value))
+                sent.append((node, client))
+            except OSError as e:
+                replicated = self._failed(node, e)
+
+        for node, client in sent:
+            try:
+                status, _ = client._recv_bin()
+                replicated = replicated and status == BIN_STATUS_OK
+            except (OSError, ValueError) as e:
+                replicated = self._failed(node, e)
+
+        return replicated
+
+    def _client(self, node: tuple) -> "Client | None":
+        """
+        Return the Client connected to a replica, connecting it first if need be. Internal method, not to be used directly.
+        Replicas are connected to on their first record, not when the Replicator is created, so a primary starts even if its replicas do not.
+        The connection is attempted once, and raises OSError if it fails: the caller backs off (see Replicator._stream and Replicator._reconnect).
+        In "sync" mode, returns None while the replica is down and being reconnected.
+        """
+        client = self.clients.get(node)
+        if client is None:
+            thread = self.threads.get(node)
+            if self.mode == "sync" and thread is not None and thread.is_alive():
+                return None
+            client = self.clients[node] = Client(node[0], node[1], 0, vocal=False, binary=True)
+        return client
+
+    def _failed(self, node: tuple, error: Exception) -> bool:
+        """
+        Report a failed replication and drop the connection to the replica. Internal method, not to be used directly.
+        In "async" mode the stream thread reconnects; in "sync" mode the replica is down until a background thread has reconnected it.
+        Always returns False.
+        """
+        if self.vocal:
+            print(f"REPLICATOR: Replication to {node} failed: {error!r}")
+        client = self.clients.pop(node, None)
+        if client is not None:
+            client.close()
+        thread = self.threads.get(node)
+        if self.mode == "sync" and not self._closing.is_set() and (thread is None or not thread.is_alive()):
+            self.threads[node] = threading.Thread(
+                target=self._reconnect, args=(node,), daemon=True)
+            self.threads[node].start()
+        return False
+
+    def _reconnect(self, node: tuple) -> None:
+        """
+        Reconnect to a replica that is down, backing off exponentially from RETRY_DELAY to MAX_RETRY_DELAY, until it answers or the Replicator is closed.
+        Run in a background thread in "sync" mode. Internal method, not to be used directly.
+        """
+        delay = RETRY_DELAY
+        while not self._closing.wait(delay):
+            try:
+                self.clients[node] = Client(node[0], node[1], 0, vocal=False, binary=True)
+            except OSError:
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            if self.vocal:
+                print(f"REPLICATOR: Reconnected to replica {node}")
+            return
+
+    def _stream(self, node: tuple) -> None:
+        """
+        Send the records queued for a replica until the Replicator is closed. Internal method, not to be used directly.
+        """
+        q = self.queues[node]
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size and not q.empty():
+                batch.append(q.get())
+            closing = batch[-1] is None
+            batch = [record for record in batch if record is not None]
+
+            delay = RETRY_DELAY
+            while batch:
+                try:
+                    statuses = self._client(node).set_many(batch, self.batch_size)
+                    if self.vocal and any(status != b"STORED " + END for status in statuses):
+                        print(f"REPLICATOR: Replica {node} did not store every record")
+                    break
+                except (OSError, ValueError) as e:
+                    self._failed(node, e)
+                # wait a little longer before each retry, and give up at once when closing
+                if self._closing.wait(delay):
+                    if self.vocal:
+                        print(f"REPLICATOR: Giving up on replica {node}, dropping {len(batch) + q.qsize()} records")
+                    return
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+            if closing:
+                return
+
+    def close(self) -> None:
+        """
+        Wait (at most self.close_timeout seconds) for the queued records to be sent, then close the connections to the replicas.
+        """
+        self._closing.set()
+        for q in self.queues.values():
+            q.put(None)
+        deadline = time.time() + self.close_timeout
+        for node, thread in list(self.threads.items()):
+            thread.join(max(deadline - time.time(), 0))
+            if thread.is_alive() and self.vocal:  # still trying to connect, closing its client makes it give up
+                print(f"REPLICATOR: Replica {node} did not catch up in time")
+        for client in list(self.clients.values()):
+            client.close()
 
 
 class Client:
     """
     Class that connects to a server and sends requests to the server.
 
-    Many Clients can connect to the same server at the same time, though they will be handled serially.
+    Many Clients can connect to the same server at the same time; the server multiplexes their connections.
 
     Requires the following parameters:
     - HOST: The IP address of the server.
     - PORT: The port that the server listens on. The client will have a random port assigned upon connection.
-    - connection_timeout: The number of seconds to keep trying to connect to the server before exiting.
+    - connection_timeout: The number of seconds to keep trying to connect to the server before giving up.
+    - binary: Whether to speak the binary protocol (see Server.dispatch_binary) instead of the text protocol.
+      Responses are returned in the same form either way.
+    - decompress: Whether gets ask for values as the server stores them, possibly compressed, and decompress them here rather than on the server.
+      This saves the network the compressed bytes. Only the binary protocol carries compressed values.
     """
 
-    def __init__(self, HOST: int | str, PORT: int, connection_timeout: int = 60, vocal: bool = True) -> None:
+    def __init__(self, HOST: int | str, PORT: int, connection_timeout: int = 60, vocal: bool = True, binary: bool = False, decompress: bool = False) -> None:
+        assert binary or not decompress, ValueError(
+            "Only the binary protocol carries compressed values")
         self.HOST = HOST
         self.PORT = PORT
         self.connection_timeout = connection_timeout
         self.vocal = vocal
-        # create a socket object, different protocols could be used
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.binary = binary
+        self.decompress = decompress
+        # the codecs gets accept, see Server.dispatch_binary
+        self.get_flags = sum(CODECS) if decompress else 0
+        self.request_id = 0  # id of the last binary request sent
+        self.s = None  # initialized in self.connect()
+        self.buf = None  # bytes received from the server but not yet consumed, initialized in self.connect()
+        self.connect()
+
+    def connect(self) -> None:
+        """
+        (Re)connect to the server, discarding any previous connection.
+        If the server cannot be reached (it is not listening, the host or network is unreachable, the connection is reset, ...),
+        keep trying for connection_timeout seconds, backing off exponentially from RETRY_DELAY to MAX_RETRY_DELAY.
+        Raises the last error (usually ConnectionRefusedError) if the server could not be reached in time.
+        """
+        if self.s is not None:
+            self.s.close()
+        self.buf = RecvBuffer()
 
-        # client will keep trying to connect to the server for connection_timeout seconds after instantiation
         start = time.time()
-        while start + self.connection_timeout > time.time():
+        delay = RETRY_DELAY
+        while True:
+            # create a socket object, different protocols could be used
+            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # let the OS probe idle connections, so long-lived (pooled) connections to a dead server are noticed
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             try:
                 # connect this socket to established server
-                self.s.connect((HOST, PORT))
-                break
+                self.s.connect((self.HOST, self.PORT))
+                return
 
-            except ConnectionRefusedError as e:  # if server is not listening, wait 5 seconds and try again
-                if start + self.connection_timeout > time.time():
-                    if vocal:
+            except OSError as e:  # if server cannot be reached, wait a little longer each time and try again
+                self.s.close()
+                if time.time() + delay > start + self.connection_timeout:
+                    if self.vocal:
                         print(
-                            f"CLIENT: Unable to connect to server at {HOST}:{PORT}, trying again in 5 seconds")
-                    time.sleep(5)
+                            f"CLIENT: Unable to connect to server at {self.HOST}:{self.PORT}, giving up")
+                    raise
 
-                else:
-                    if vocal:
-                        print(
-                            f"CLIENT: Unable to connect to server at {HOST}:{PORT}, exiting")
-                    quit()
+                if self.vocal:
+                    print(
+                        f"CLIENT: Unable to connect to server at {self.HOST}:{self.PORT}, trying again in {delay*1000:.0f} ms")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
 
     def get(self, key: bytes) -> (bytes, bytes, bytes):
         """
@@ -246,53 +1152,88 @@ class Client:
         assert isinstance(key, bytes), TypeError(
             f"Key must be of type bytes, not: {type(key)}")
 
+        if self.binary:
+            self.s.sendall(self._bin_msg(BIN_OP_GET, key, flags=self.get_flags))
+            status, value = self._recv_bin()
+            if status != BIN_STATUS_OK:
+                return b"KEY NOT FOUND " + END, b"", b""
+            header = b" ".join((b"VALUE", key.ljust(KEY_SIZE, b" "),
+                               len(value).to_bytes(INT_SIZE, byteorder=INT_ORDER)))
+            return header, value, b"END " + END
+
         key = key.ljust(KEY_SIZE, b" ")
         text_msg = b" ".join((b"get", key, END))
-        time.sleep(SLEEPTIME)
 
-        print(text_msg)  # ^
+        if self.vocal:
+            print(text_msg)  # ^
         self.s.sendall(text_msg)
-        # receive components of the response
-        header = []
-        while True:
-            partial = self.s.recv(BUF_SIZE)
-            header.append(partial)
 
-            if END in partial:
-                break
+        # receive components of the response, the not found response is shorter than a header so read that much first
+        not_found = b"KEY NOT FOUND " + END
+        header = self._recv_exact(len(not_found))
+        if header == not_found:
+            return header, b"", b""
 
-            elif not partial:
-                if self.vocal:
-                    print(f"CLIENT: Server disconnected")
-                break
+        # read the rest of the header and extract size of value
+        header += self._recv_exact(VALUE_HEADER_SIZE - len(not_found))
+        header = header[0:VALUE_HEADER_SIZE-1-END_SIZE]
+        size = int.from_bytes(header[-INT_SIZE:], "big")
 
-        # join header fragments and extract size of value
-        header = b"".join(header)
-        end_loc = header.find(END) - 1
-        if header == b"KEY NOT FOUND " + END:
-            return header, b"", b""
+        # receive data block (value) and end
+        value = self._recv_exact(size + 1 + END_SIZE, keep=size)
+        end = self._recv_exact(len(b"END ") + END_SIZE)
 
-        header = header[0:end_loc]
-        size = int.from_bytes(
-            header[end_loc-INT_SIZE:end_loc], "big") + 1 + END_SIZE
-        nbytes = size
+        return header, value, end
 
-        # receive data block (value)
-        data = []
-        while nbytes > 0:
-            partial = self.s.recv(BUF_SIZE)
-            data.append(partial)
-            nbytes -= len(partial)
+    def get_many(self, keys: list) -> dict:
+        """
+        Validate keys and send a single get message for all of them to the server.
+        Return a dictionary of key -> value for every key found; keys that are not found are left out.
 
-            if not partial:
-                if self.vocal:
-                    print(f"CLIENT: Server disconnected")
-                break
+        Requires the following parameters:
+        - keys: The keys to get from the server. Each is validated and padded as in Client.get, and may not start with END.
+        """
+        for key in keys:
+            assert 1 <= len(key) <= KEY_SIZE, ValueError(
+                f"Key length must be between 1-{KEY_SIZE} bytes, key of size {len(key)}b was passed")
+            assert isinstance(key, bytes), TypeError(
+                f"Key must be of type bytes, not: {type(key)}")
+            # the server would read a key starting with END as the end of the request
+            assert not key.startswith(END), ValueError(
+                f"Key must not start with {END!r}, key {key!r} was passed")
+
+        values = {}
+        if not keys:
+            return values
+
+        if self.binary:  # pipeline one get per key
+            keys = list(dict.fromkeys(keys))
+            self.s.sendall(b"".join(self._bin_msg(BIN_OP_GET, key, flags=self.get_flags) for key in keys))
+            for key in keys:
+                status, value = self._recv_bin()
+                if status == BIN_STATUS_OK:
+                    values[key] = value
+            return values
+
+        if len(set(keys)) == 1:  # the server answers a single-key get as in Client.get
+            _, value, end = self.get(keys[0])
+            if end:
+                values[keys[0]] = value
+            return values
+
+        padded = {key.ljust(KEY_SIZE, b" "): key for key in keys}
+        text_msg = b" ".join((b"get", *padded, END))
+
+        if self.vocal:
+            print(text_msg)  # ^
+        self.s.sendall(text_msg)
 
-        value = b"".join(data).rstrip(b" " + END)
-        end = self.s.recv(4 + len(END))
+        # receive value blocks until the end of the response
+        while (pair := self._recv_value()) is not None:
+            key, value = pair
+            values[padded[key]] = value
 
-        return header, value, end
+        return values
 
     def set(self, key: bytes, value: bytes) -> bytes:
         """
@@ -311,110 +1252,1202 @@ class Client:
         assert 1 <= len(value) <= 2**(INT_SIZE*8 - 1), ValueError(
             f"Value length must be between 1-{2**(INT_SIZE*8 - 1)} bytes, value of size {len(value)}b was passed")
 
+        if self.binary:
+            self.s.sendall(self._bin_msg(BIN_OP_SET, key, value))
+            status, _ = self._recv_bin()
+            return self._set_status(status)
+
         key = key.ljust(KEY_SIZE, b" ")
         text_msg = self._set_msg(key, value)
-        data_msg = value + b' ' + END
 
-        print(text_msg)  # ^
-        print(data_msg)  # ^
+        if self.vocal:
+            print(text_msg)  # ^
+            print(value + b' ' + END)  # ^
 
-        # continue trying to send message until server sends acknowledgement and status
-        status = b""
-        while not status:
-            time.sleep(SLEEPTIME)
+        if len(value) <= BUF_SIZE:
+            self.s.sendall(text_msg + value + b' ' + END)
+        else:  # don't copy large values just to send them in one call
             self.s.sendall(text_msg)
-            time.sleep(SLEEPTIME)
-            self.s.sendall(data_msg)
+            self.s.sendall(value)
+            self.s.sendall(b' ' + END)
 
-            response = []
-            while True:
-                partial = self.s.recv(BUF_SIZE)
-                response.append(partial)
+        status = self._recv_line()
+        if status not in (b"STORED " + END, b"NOT STORED " + END, b"NOT REPLICATED " + END):
+            # check to make sure server response is well-formed
+            raise ValueError(
+                f"CLIENT: Server response not recognized: {status!r}")
 
-                if END in partial:
-                    break
+        return status
 
-                elif not partial:
-                    if self.vocal:
-                        print(f"CLIENT: Server disconnected")
-                    break
+    def set_many(self, items: dict, batch_size: int = 1000) -> list:
+        """
+        Validate and send many set messages to the server without waiting for each response (pipelining).
+        The responses are read once a whole batch has been sent, so a batch costs one round trip instead of one per key.
+        Return the list of statuses, in the same order as items.
 
-            status = b"".join(response)
-            if status not in (b"STORED " + END, b"NOT STORED " + END):
-                # check to make sure server response is well-formed
-                raise ValueError(
-                    f"CLIENT: Server response not recognized: {status!r}")
+        Requires the following parameters:
+        - items: A dictionary of key -> value, or a list of (key, value) pairs, to set in the server. Keys and values are validated as in Client.set.
+        - batch_size: The number of set messages to send before reading their responses.
+        """
+        items = list(items.items()) if isinstance(items, dict) else list(items)
+        for key, value in items:
+            assert 1 <= len(key) <= KEY_SIZE, ValueError(
+                f"Key length must be between 1-{KEY_SIZE} bytes, key of size {len(key)}b was passed")
+            assert isinstance(key, bytes), TypeError(
+                f"Key must be of type bytes, not: {type(key)}")
+            assert isinstance(value, bytes), TypeError(
+                f"Value must be of type bytes, not: {type(value)}")
+            assert 1 <= len(value) <= 2**(INT_SIZE*8 - 1), ValueError(
+                f"Value length must be between 1-{2**(INT_SIZE*8 - 1)} bytes, value of size {len(value)}b was passed")
+
+        statuses = []
+        for batch_start in range(0, len(items), batch_size):
+            batch = items[batch_start:batch_start+batch_size]
+            msgs = []
+            for key, value in batch:
+                if self.binary:
+                    msgs.append(self._bin_msg(BIN_OP_SET, key, value))
+                else:
+                    msgs.append(self._set_msg(key.ljust(KEY_SIZE, b" "), value))
+                    msgs.append(value + b" " + END)
+
+            self.s.sendall(b"".join(msgs))
+
+            for _ in batch:
+                if self.binary:
+                    status, _ = self._recv_bin()
+                    statuses.append(self._set_status(status))
+                    continue
+                status = self._recv_line()
+                if status not in (b"STORED " + END, b"NOT STORED " + END, b"NOT REPLICATED " + END):
+                    # check to make sure server response is well-formed
+                    raise ValueError(
+                        f"CLIENT: Server response not recognized: {status!r}")
+                statuses.append(status)
+
+        return statuses
+
+    def scan(self, start: bytes = b"", end: bytes | None = None, limit: int | None = None, prefix: bytes | None = None):
+        """
+        Send a scan request to the server, and yield the (key, value) pairs it streams back in key order:
+        every key with start <= key < end (no upper bound if end is None), at most limit of them (no limit if None). See Server.recv_scan.
+        Pairs are yielded as they arrive, so the whole result is never held in memory.
+        If the generator is closed before the end, the rest of the response is read and dropped, so the Client can be used again.
 
-        return status
+        Requires the following parameters:
+        - start, end: The bounds of the keys to scan. Each must be a bytes object of at most KEY_SIZE bytes.
+        - limit: The most pairs to return.
+        - prefix: If given, replaces start and end to scan exactly the keys that start with it (see prefix_range).
+        """
+        if prefix is not None:
+            start, end = prefix_range(prefix)
+        for bound in (start, end or b""):
+            assert isinstance(bound, bytes), TypeError(
+                f"Key must be of type bytes, not: {type(bound)}")
+            assert len(bound) <= KEY_SIZE, ValueError(
+                f"Key length must be at most {KEY_SIZE} bytes, key of size {len(bound)}b was passed")
+        limit_bytes = (limit or 0).to_bytes(INT_SIZE, byteorder=INT_ORDER)
+
+        if self.binary:
+            self.s.sendall(self._bin_msg(BIN_OP_SCAN, start, limit_bytes + (end or b"")))
+            recv_pair = self._recv_bin_pair
+        else:
+            text_msg = b" ".join((b"scan", start.ljust(KEY_SIZE, b" "),
+                                  (end or b"").ljust(KEY_SIZE, b" "), limit_bytes, END))
+            if self.vocal:
+                print(text_msg)  # ^
+            self.s.sendall(text_msg)
+            recv_pair = self._recv_value
 
-    def _set_msg(self, key: bytes, value: bytes) -> bytes:
+        try:
+            while (pair := recv_pair()) is not None:
+                key, value = pair
+                # text protocol keys arrive padded to KEY_SIZE
+                yield (key if self.binary else key.rstrip(b" ")), value
+        except GeneratorExit:
+            # read the rest of the response, so the next request finds the connection clean
+            while recv_pair() is not None:
+                pass
+            raise
+
+    def stats(self) -> dict:
         """
-        Format a set message to be sent to the server. Internal method, not to be used directly.
+        Send a stats request to the server. Return a dictionary of statistic name -> value (a string), see Server.stats.
         """
-        size = (len(value) + 1 + END_SIZE).to_bytes(INT_SIZE, 'big')
-        msg_parts = (b'set', key, size, END)
-        msg = b" ".join(msg_parts)
-        return msg
+        if self.binary:
+            self.s.sendall(self._bin_msg(BIN_OP_STATS, b""))
+            _, value = self._recv_bin()
+            lines = value.split(END)[:-1]
+        else:
+            if self.vocal:
+                print(STATS_REQUEST)  # ^
+            self.s.sendall(STATS_REQUEST)
+            lines = []
+            while (line := self._recv_line()) != b"END " + END:
+                lines.append(line[:-END_SIZE])
+
+        stats = {}
+        for line in lines:
+            _, name, value = line.decode().split()
+            stats[name] = value
+        return stats
 
-    def close(self):
+    def _recv_exact(self, nbytes: int, keep: int | None = None) -> bytes:
         """
-        Close the client's connection to the server and terminate client socket.
+        Block until exactly nbytes have been received from the server and return the first keep of them (all of them by default).
+        Internal method, not to be used directly.
+        Bytes received past nbytes are kept in self.buf for the next read.
         """
-        self.s.close()
-
+        self.buf.reserve(nbytes)
+        while len(self.buf) < nbytes:
+            if not self.buf.recv_into(self.s):
+                if self.vocal:
+                    print(f"CLIENT: Server disconnected")
+                raise ConnectionError("Server disconnected")
 
-class KVStore:
-    """
-    A simple file-based key-value store.
-    This is a bytes file; it cannot be navigated by line, only by byte.
-    The first KEY_SIZE bytes of the file are the first key, followed by INT_SIZE bytes for the size of the value, followed by the value itself.
-    There is no delimiter between key, size, and value; you must navigate the file by reading every key-size-value block until you read b"".
-    It is not recommended to use this class directly; it is used by the Server class to store key-value pairs.
+        data = bytes(self.buf.peek(nbytes if keep is None else keep))
+        self.buf.consume(nbytes)
+        return data
 
-    Requires the following parameters:
+    def _recv_line(self) -> bytes:
+        """
+        Block until a full END-terminated line has been received from the server and return it, including END.
+        Internal method, not to be used directly.
+        """
+        while (end_loc := self.buf.find(END)) == -1:
+            if not self.buf.recv_into(self.s):
+                if self.vocal:
+                    print(f"CLIENT: Server disconnected")
+                raise ConnectionError("Server disconnected")
+
+        return self._recv_exact(end_loc + END_SIZE)
+
+    def _bin_msg(self, opcode: int, key: bytes, value: bytes = b"", flags: int = 0) -> bytes:
+        """
+        Format a binary request to be sent to the server. Internal method, not to be used directly.
+        """
+        self.request_id = (self.request_id + 1) % 2**32
+        header = BIN_HEADER.pack(BIN_REQUEST_MAGIC, opcode, flags, 0,
+                                 len(key), len(value), self.request_id)
+        return b"".join((header, key, value))
+
+    @staticmethod
+    def _set_status(status: int) -> bytes:
+        """
+        Return the text protocol status of a binary set response with the given status. Internal method, not to be used directly.
+        """
+        if status == BIN_STATUS_OK:
+            return b"STORED " + END
+        if status == BIN_STATUS_NOT_REPLICATED:
+            return b"NOT REPLICATED " + END
+        return b"NOT STORED " + END
+
+    def _recv_bin(self) -> (int, bytes):
+        """
+        Receive a binary response from the server and return its status and value. Internal method, not to be used directly.
+        Responses arrive in the order the requests were sent.
+        """
+        status, _, value = self._recv_bin_key()
+        return status, value
+
+    def _recv_bin_key(self) -> (int, bytes, bytes):
+        """
+        Receive a binary response from the server and return its status, key, and value. Internal method, not to be used directly.
+        Only the responses of a scan carry a key. A compressed value (only sent to a Client that asked for them) is decompressed.
+        """
+        magic, _, flags, status, key_len, value_len, request_id = BIN_HEADER.unpack(
+            self._recv_exact(BIN_HEADER.size))
+        if magic != BIN_RESPONSE_MAGIC:
+            raise ValueError(
+                f"CLIENT: Server response not recognized: magic {magic:#x}")
+        key = self._recv_exact(key_len)
+        value = self._recv_exact(value_len)
+        if flags:
+            value = CODECS[flags].decompress(value)
+        return status, key, value
+
+    def _recv_bin_pair(self) -> tuple | None:
+        """
+        Receive one response of a binary scan. Return its key and value, or None at the end of the scan. Internal method, not to be used directly.
+        """
+        status, key, value = self._recv_bin_key()
+        return (key, value) if status == BIN_STATUS_OK else None
+
+    def _recv_value(self) -> tuple | None:
+        """
+        Receive one value block of a multi-key get or scan response. Internal method, not to be used directly.
+        Return its key (padded to KEY_SIZE, as sent) and value, or None at the END of the response.
+        """
+        # a header starts with b"VALUE ", which is as long as the b"END {END}" that follows the last one
+        header = self._recv_exact(len(b"VALUE "))
+        if header == b"END " + END:
+            return None
+        header += self._recv_exact(VALUE_HEADER_SIZE - len(b"VALUE "))
+        key = header[len(b"VALUE "):len(b"VALUE ")+KEY_SIZE]
+        size = int.from_bytes(
+            header[-INT_SIZE-1-END_SIZE:-1-END_SIZE], "big")
+        return key, self._recv_exact(size + 1 + END_SIZE, keep=size)
+
+    def _set_msg(self, key: bytes, value: bytes) -> bytes:
+        """
+        Format a set message to be sent to the server. Internal method, not to be used directly.
+        """
+        size = (len(value) + 1 + END_SIZE).to_bytes(INT_SIZE, 'big')
+        msg_parts = (b'set', key, size, END)
+        msg = b" ".join(msg_parts)
+        return msg
+
+    def close(self):
+        """
+        Close the client's connection to the server and terminate client socket.
+        """
+        self.s.close()
+
+
+class ClientPool:
+    """
+    A pool of Clients connected to the same server, leased to one thread at a time.
+    The connections are opened when the pool is created and kept open, so callers don't pay for a TCP handshake on every request.
+
+    If a request fails because the connection broke, the Client is reconnected in the background
+    (with the same exponential backoff as Client.connect) and returned to the pool once it is connected again;
+    the error is raised to the caller, whose request may or may not have been executed.
+
+    Requires the following parameters:
+    - HOST: The IP address of the server.
+    - PORT: The port that the server listens on.
+    - size: The number of connections to keep.
+    - connection_timeout: The number of seconds each connection attempt keeps retrying before giving up.
+    - vocal: Whether the Clients print information about their state to the console.
+    - binary: Whether the Clients speak the binary protocol.
+    - decompress: Whether the Clients decompress values themselves (see Client).
+    """
+
+    def __init__(self, HOST: int | str, PORT: int, size: int = 8, connection_timeout: int = 60, vocal: bool = False, binary: bool = False, decompress: bool = False) -> None:
+        self.HOST = HOST
+        self.PORT = PORT
+        self.size = size
+        self.connection_timeout = connection_timeout
+        self.vocal = vocal
+        self.binary = binary
+        self.decompress = decompress
+        self.closed = False
+        self.idle = queue.Queue()  # connected Clients that are not leased
+        for _ in range(size):
+            self.idle.put(Client(HOST, PORT, connection_timeout, vocal, binary, decompress))
+
+    @contextmanager
+    def lease(self, timeout: float | None = None):
+        """
+        Context manager that leases a connected Client for the duration of the block.
+        Waits up to timeout seconds (forever by default) for one to become available, raising queue.Empty otherwise.
+        """
+        client = self.idle.get(timeout=timeout)
+        try:
+            yield client
+
+        except (OSError, ValueError):  # the connection is broken or out of sync with the server
+            self._reconnect(client)
+            raise
+
+        except BaseException:
+            self._release(client)
+            raise
+
+        else:
+            self._release(client)
+
+    def _release(self, client: Client) -> None:
+        """
+        Return a leased Client to the pool, or close it if the pool has been closed. Internal method, not to be used directly.
+        """
+        if self.closed:
+            client.close()
+        else:
+            self.idle.put(client)
+
+    def _reconnect(self, client: Client) -> None:
+        """
+        Reconnect a Client in a background thread and return it to the pool. Internal method, not to be used directly.
+        A Client that cannot reconnect within its connection_timeout keeps trying until the pool is closed.
+        """
+        def reconnect():
+            while not self.closed:
+                try:
+                    client.connect()
+                except OSError:
+                    continue
+                self._release(client)
+                return
+            client.close()
+
+        threading.Thread(target=reconnect, daemon=True).start()
+
+    def get(self, key: bytes) -> (bytes, bytes, bytes):
+        """
+        Lease a Client and call Client.get.
+        """
+        with self.lease() as client:
+            return client.get(key)
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Lease a Client and call Client.get_many.
+        """
+        with self.lease() as client:
+            return client.get_many(keys)
+
+    def set(self, key: bytes, value: bytes) -> bytes:
+        """
+        Lease a Client and call Client.set.
+        """
+        with self.lease() as client:
+            return client.set(key, value)
+
+    def set_many(self, items: dict, batch_size: int = 1000) -> list:
+        """
+        Lease a Client and call Client.set_many.
+        """
+        with self.lease() as client:
+            return client.set_many(items, batch_size)
+
+    def scan(self, start: bytes = b"", end: bytes | None = None, limit: int | None = None, prefix: bytes | None = None):
+        """
+        Lease a Client and yield from Client.scan. The Client is returned once the scan is exhausted or closed.
+        """
+        with self.lease() as client:
+            yield from client.scan(start, end, limit, prefix)
+
+    def stats(self) -> dict:
+        """
+        Lease a Client and call Client.stats.
+        """
+        with self.lease() as client:
+            return client.stats()
+
+    def close(self) -> None:
+        """
+        Close every idle connection and stop reconnecting the broken ones. Leased Clients should be returned first.
+        """
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto a set of nodes (servers), each identified by a (HOST, PORT) tuple.
+
+    Every node is placed on a ring of 64-bit hashes at vnodes points (virtual nodes), and a key belongs to the first node point at or after its own hash.
+    Adding or removing one of N nodes therefore only moves ~1/N of the keys, and spreading each node over many points keeps the shares even.
+    Keys are hashed without their space padding, so a key maps to the same node whether or not it has been padded to KEY_SIZE.
+
+    Requires the following parameters:
+    - nodes: The (HOST, PORT) tuples of the nodes.
+    - vnodes: The number of points each node has on the ring.
+    """
+
+    def __init__(self, nodes: list, vnodes: int = 100) -> None:
+        self.vnodes = vnodes
+        self.nodes = []
+        self.hashes = []  # sorted hashes of the node points
+        self.points = {}  # hash of a node point -> node
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(data: bytes) -> int:
+        """
+        Hash data onto the ring. Internal method, not to be used directly.
+        """
+        return int.from_bytes(hashlib.md5(data).digest()[:8], byteorder="big")
+
+    def add_node(self, node: tuple) -> None:
+        """
+        Place a node on the ring.
+        """
+        node = tuple(node)
+        self.nodes.append(node)
+        for i in range(self.vnodes):
+            point = self._hash(f"{node[0]}:{node[1]}#{i}".encode("utf-8"))
+            if point in self.points:  # astronomically unlikely, skip rather than steal another node's point
+                continue
+            self.points[point] = node
+            bisect.insort(self.hashes, point)
+
+    def remove_node(self, node: tuple) -> None:
+        """
+        Take a node off the ring; its keys now belong to the nodes after its points.
+        """
+        node = tuple(node)
+        self.nodes.remove(node)
+        self.hashes = [point for point in self.hashes if self.points[point] != node]
+        self.points = {point: self.points[point] for point in self.hashes}
+
+    def node_for(self, key: bytes) -> tuple:
+        """
+        Return the node that key belongs to.
+        """
+        assert self.hashes, ValueError("HashRing has no nodes")
+        i = bisect.bisect_left(self.hashes, self._hash(key.rstrip(b" ")))
+        return self.points[self.hashes[i % len(self.hashes)]]
+
+
+class ShardedClient:
+    """
+    Client for a cluster of Servers that each hold a shard of the keys, e.g. several servers on different ports of one host.
+    Every request is routed to the server that owns its key on a HashRing; get_many and set_many send one batch per server.
+    Each server is reached through its own ClientPool, so a ShardedClient can be shared between threads.
+
+    When servers are added to or removed from the cluster, the keys that change owner must be moved between their KVStore files (see rebalance).
+
+    Requires the following parameters:
+    - nodes: The (HOST, PORT) tuples of the servers.
+    - vnodes: The number of points each server has on the HashRing.
+    - pool_size: The number of connections to keep to each server.
+    - connection_timeout: The number of seconds each connection attempt keeps retrying before giving up.
+    - binary: Whether to speak the binary protocol.
+    - decompress: Whether to decompress values on the client (see Client).
+    """
+
+    def __init__(self, nodes: list, vnodes: int = 100, pool_size: int = 1, connection_timeout: int = 60, binary: bool = False, decompress: bool = False) -> None:
+        self.ring = HashRing(nodes, vnodes)
+        self.pools = {node: ClientPool(node[0], node[1], pool_size, connection_timeout, binary=binary, decompress=decompress)
+                      for node in self.ring.nodes}
+
+    def get(self, key: bytes) -> (bytes, bytes, bytes):
+        """
+        Call Client.get on the server that owns key.
+        """
+        return self.pools[self.ring.node_for(key)].get(key)
+
+    def set(self, key: bytes, value: bytes) -> bytes:
+        """
+        Call Client.set on the server that owns key.
+        """
+        return self.pools[self.ring.node_for(key)].set(key, value)
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Call Client.get_many on every server that owns some of the keys, and merge the results.
+        """
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.ring.node_for(key), []).append(key)
+
+        values = {}
+        for node, shard_keys in shards.items():
+            values.update(self.pools[node].get_many(shard_keys))
+        return values
+
+    def set_many(self, items: dict, batch_size: int = 1000) -> list:
+        """
+        Call Client.set_many on every server that owns some of the keys. Return the statuses in the same order as items.
+        """
+        items = list(items.items()) if isinstance(items, dict) else list(items)
+        shards = {}
+        for i, (key, value) in enumerate(items):
+            shards.setdefault(self.ring.node_for(key), []).append((i, key, value))
+
+        statuses = [None] * len(items)
+        for node, shard_items in shards.items():
+            shard_statuses = self.pools[node].set_many(
+                [(key, value) for _, key, value in shard_items], batch_size)
+            for (i, _, _), status in zip(shard_items, shard_statuses):
+                statuses[i] = status
+        return statuses
+
+    def scan(self, start: bytes = b"", end: bytes | None = None, limit: int | None = None, prefix: bytes | None = None):
+        """
+        Call Client.scan on every server, and yield the (key, value) pairs of all of them merged in key order.
+        Keys are hashed onto the servers, so any range may span all of them; each server returns at most limit pairs, of which the first limit overall are kept.
+        """
+        scans = [pool.scan(start, end, limit, prefix)
+                 for pool in self.pools.values()]
+        merged = heapq.merge(*scans, key=lambda pair: pair[0])
+        try:
+            yield from itertools.islice(merged, limit or None)
+        finally:
+            for scan in scans:
+                scan.close()
+
+    def stats(self) -> dict:
+        """
+        Call Client.stats on every server. Return a dictionary of (HOST, PORT) -> statistics.
+        """
+        return {node: pool.stats() for node, pool in self.pools.items()}
+
+    def close(self) -> None:
+        """
+        Close the connections to every server.
+        """
+        for pool in self.pools.values():
+            pool.close()
+
+
+class ReplicatedClient:
+    """
+    Client for a primary Server and its replicas (see Replicator): sets go to the primary, gets are spread round-robin over the replicas.
+    Each server is reached through its own ClientPool, so a ReplicatedClient can be shared between threads.
+    With "async" replication, a get from a replica may briefly return the value from before a recent set.
+
+    Requires the following parameters:
+    - primary: The (HOST, PORT) tuple of the primary Server.
+    - replicas: The (HOST, PORT) tuples of the replica Servers.
+    - read_from_primary: Whether the primary also serves gets.
+    - pool_size: The number of connections to keep to each server.
+    - connection_timeout: The number of seconds each connection attempt keeps retrying before giving up.
+    - binary: Whether to speak the binary protocol.
+    - decompress: Whether to decompress values on the client (see Client).
+    """
+
+    def __init__(self, primary: tuple, replicas: list, read_from_primary: bool = False, pool_size: int = 1, connection_timeout: int = 60, binary: bool = False, decompress: bool = False) -> None:
+        self.primary = ClientPool(
+            primary[0], primary[1], pool_size, connection_timeout, binary=binary, decompress=decompress)
+        self.replicas = [ClientPool(node[0], node[1], pool_size, connection_timeout, binary=binary, decompress=decompress)
+                         for node in replicas]
+        readers = self.replicas + [self.primary] if read_from_primary or not self.replicas else self.replicas
+        self.readers = itertools.cycle(readers)
+
+    def get(self, key: bytes) -> (bytes, bytes, bytes):
+        """
+        Call Client.get on the next reader.
+        """
+        return next(self.readers).get(key)
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Call Client.get_many on the next reader.
+        """
+        return next(self.readers).get_many(keys)
+
+    def scan(self, start: bytes = b"", end: bytes | None = None, limit: int | None = None, prefix: bytes | None = None):
+        """
+        Yield from Client.scan on the next reader.
+        """
+        yield from next(self.readers).scan(start, end, limit, prefix)
+
+    def set(self, key: bytes, value: bytes) -> bytes:
+        """
+        Call Client.set on the primary.
+        """
+        return self.primary.set(key, value)
+
+    def set_many(self, items: dict, batch_size: int = 1000) -> list:
+        """
+        Call Client.set_many on the primary.
+        """
+        return self.primary.set_many(items, batch_size)
+
+    def close(self) -> None:
+        """
+        Close the connections to every server.
+        """
+        self.primary.close()
+        for pool in self.replicas:
+            pool.close()
+
+
+def rebalance(old_nodes: list, new_nodes: list, kvstore_paths: dict, vnodes: int = 100, vocal: bool = True, compression: str | None = None) -> dict:
+    """
+    Move the key-value pairs whose owner changes between two cluster layouts from the KVStore file of the old owner to that of the new owner.
+    The servers of the cluster must be stopped while this runs, since each of them keeps its own index of its KVStore file.
+
+    Pairs are streamed one at a time, so only one value is in memory at once.
+    The source files are opened in append-only mode, so each move is an append to both files, and are compacted once at the end.
+
+    Requires the following parameters:
+    - old_nodes: The (HOST, PORT) tuples of the servers before the change.
+    - new_nodes: The (HOST, PORT) tuples of the servers after the change.
+    - kvstore_paths: A dictionary of (HOST, PORT) -> KVStore path, for every node in old_nodes or new_nodes.
+    - vnodes: The number of points each server has on the HashRing, as used by the ShardedClient.
+    - vocal: Whether to print the number of pairs moved out of each file.
+    - compression: The compression of the servers' kvstores, so that moved values are compressed again in their new file (see KVStore).
+
+    Returns a dictionary of (source node, destination node) -> number of pairs moved.
+    """
+    new_ring = HashRing(new_nodes, vnodes)
+    stores = {tuple(node): KVStore(path, append_only=True, compression=compression)
+              for node, path in kvstore_paths.items()}
+    moved = {}
+
+    for node in map(tuple, old_nodes):
+        source = stores[node]
+        for key, value in source.items():
+            owner = new_ring.node_for(key)
+            if owner == node:
+                continue
+            status = stores[owner].set(key, value, len(
+                value).to_bytes(INT_SIZE, byteorder=INT_ORDER))
+            if status != b"STORED " + END:
+                raise RuntimeError(
+                    f"Could not move key {key!r} from {node} to {owner}")
+            source.delete(key)
+            moved[(node, owner)] = moved.get((node, owner), 0) + 1
+
+        if vocal:
+            print(
+                f"REBALANCE: Moved {sum(n for (src, _), n in moved.items() if src == node)} pairs out of {source.path}")
+
+    for store in stores.values():
+        store.compact()
+        store.close()
+
+    return moved
+
+
+def prefix_range(prefix: bytes) -> tuple:
+    """
+    Return the (start, end) range of a scan that covers exactly the keys that start with prefix (see KVStore.scan).
+    end is None if no key is past the prefix (an empty prefix, or one made only of b"\xff" bytes).
+    """
+    end = prefix.rstrip(b"\xff")
+    if not end:
+        return prefix, None
+    return prefix, end[:-1] + bytes([end[-1] + 1])
+
+
+class RecvBuffer:
+    """
+    A reusable receive buffer for a socket. Data is received straight into a preallocated bytearray with socket.recv_into,
+    and read back as memoryviews by offset, so received bytes are not copied until (and unless) the caller copies them.
+    Consumed bytes are reclaimed by moving the unconsumed bytes to the front of the buffer, which only happens when more room is needed.
+    Once a buffer that grew for a large message is empty, it drops back to its initial capacity.
+    It is not recommended to use this class directly; it is used by the Server and Client classes.
+
+    Requires the following parameters:
+    - capacity: The initial size (in bytes) of the buffer. The buffer grows as needed to hold a whole message.
+    """
+
+    def __init__(self, capacity: int = BUF_SIZE) -> None:
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0  # position of the first unconsumed byte
+        self.end = 0  # position after the last received byte
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def reserve(self, nbytes: int) -> None:
+        """
+        Make sure the buffer can hold nbytes unconsumed bytes without moving them again.
+        """
+        if self.start + nbytes <= len(self.buf):
+            return
+
+        size = len(self)
+        if nbytes <= len(self.buf):
+            # enough room once the consumed bytes are reclaimed
+            self.buf[:size] = self.view[self.start:self.end]
+        else:
+            buf = bytearray(max(nbytes, 2 * len(self.buf)))
+            buf[:size] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = size
+
+    def recv_into(self, sock: socket.socket) -> int:
+        """
+        Receive from sock into the free space at the end of the buffer. Return the number of bytes received (0 if sock was closed).
+        """
+        if self.end == len(self.buf):
+            self.reserve(len(self) + BUF_SIZE)
+        nbytes = sock.recv_into(self.view[self.end:])
+        self.end += nbytes
+        return nbytes
+
+    def peek(self, nbytes: int, offset: int = 0) -> memoryview:
+        """
+        Return a view of nbytes unconsumed bytes, starting offset bytes after the first one.
+        The view is only valid until the bytes are consumed.
+        """
+        start = self.start + offset
+        return self.view[start:min(start + nbytes, self.end)]
+
+    def find(self, sub: bytes, offset: int = 0) -> int:
+        """
+        Return the position of sub among the unconsumed bytes, or -1 if it is not there.
+        """
+        loc = self.buf.find(sub, self.start + offset, self.end)
+        return loc - self.start if loc != -1 else -1
+
+    def consume(self, nbytes: int) -> None:
+        """
+        Mark nbytes as read.
+        """
+        self.start += nbytes
+        if self.start == self.end:  # empty, start over at the front
+            self.start = self.end = 0
+            if len(self.buf) > self.capacity:
+                # a new buffer, so that views of the consumed bytes stay valid
+                self.buf = bytearray(self.capacity)
+                self.view = memoryview(self.buf)
+
+
+class KVStore:
+    """
+    A simple file-based key-value store.
+    This is a bytes file; it cannot be navigated by line, only by byte.
+    The file starts with KVSTORE_HEADER and a random file id, followed by one record per key-value pair: a RECORD_HEADER holding a CRC-32 checksum of the record,
+    the codec the value is compressed with (if any), the length of the key, the size of the value, and a CRC-32 checksum of the header,
+    followed by the key itself, followed by the value itself.
+    Keys are stored as they are, without padding, so a small key costs only its own bytes.
+    There is no delimiter between records, so the file is read every record at a time until b"" is read.
+    To avoid doing this on every request, an in-memory index of key -> (offset, size, flags) is built upon instantiation,
+    where offset is the position of the record in the file and flags the codec its value is compressed with. The index is kept current on every append and rewrite,
+    so a get is a single seek and read.
+    The keys of the index are also kept in a sorted list, so the pairs of a range or prefix of keys can be iterated in key order (see KVStore.scan).
+    A file in an older layout (see KVStore._migrate) is migrated to the current one upon instantiation.
+
+    Every so often the index is written to a snapshot file next to the file (see KVStore.snapshot), and always when the store is closed.
+    Upon instantiation the snapshot is loaded, and only the records appended after it are scanned, so a restart does not read the values already in the file.
+    Scanned records are checked against their checksums: a torn write at the end of the file is truncated, and a corrupt record before it is skipped
+    as dead bytes (see KVStore._scan), so a bad record never costs the records after it. The header has its own checksum, so a torn record is
+    recognized from its header alone, and only a corrupt header makes the scan search for the next good record.
+    The file is only ever replaced whole: rewrites, compactions, and migrations write a temporary file, fsync it, and swap it in with os.replace,
+    so a crash leaves either the old file or the new one. Every new file gets a new file id, which invalidates the snapshots of the old one;
+    a rewrite writes a snapshot of the new file along with it (see KVStore._rewrite), so in either mode a restart only scans what was appended since the last snapshot.
+    It is not recommended to use this class directly; it is used by the Server class to store key-value pairs.
+
+    By default, updating a key rewrites every pair after it (see KVStore._rewrite), so the file only ever holds one pair per key.
+    In append-only mode, an update is simply appended to the end of the file and the index points at the newest pair, which makes every write a single append.
+    A deletion is appended as a pair with an empty value (a tombstone), which is why empty values cannot be stored.
+    The superseded pairs and tombstones are dead bytes; once they make up more than compaction_threshold of the file, a background thread compacts the file (see KVStore.compact).
+
+    The file is opened once and kept open; values are read with os.pread and pairs are written with os.pwritev, without seeking.
+    Within a KVStore.group_commit block, sets and deletes are only queued, and the whole batch is written with one system call when it exits.
+    How durable a write is depends on the fsync policy:
+    - "always": a set or delete (or a group commit) returns only once it is on disk. Threads that commit at the same time share one fsync.
+    - a number of milliseconds: a background thread fsyncs the file that often, so at most that much of the latest writes can be lost.
+    - "never": the file is only fsynced on close; the operating system decides when writes reach the disk.
+
+    With compression, a value of at least compression_min_bytes is compressed when it is set, and stored compressed if that makes it smaller.
+    KVStore.get decompresses it again, unless asked for the value as it is stored (as the Server does, see Server._decompressed).
+
+    In shared mode, several processes (see Server, shared) use the same file, each with its own KVStore and index, coordinated by flock on a lock file next to it.
+    A process writing holds the lock exclusively from its first set or delete until the commit that writes them, and catches up with the records
+    the other processes appended (see KVStore._refresh) before queueing its own at the end of the file. A get or scan holds it shared, and catches up first too,
+    so every process sees every committed write. A file replaced by another process (a rewrite or a compaction) is reopened and its index rebuilt.
+
+    Requires the following parameters:
     - path: The path to the file used to store key-value pairs.
+    - append_only: Whether to append updates instead of rewriting the file.
+    - compaction_threshold: The fraction of the file that must be dead bytes before it is compacted. Only used in append-only mode.
+    - compaction_min_bytes: Files smaller than this many bytes are never compacted. Only used in append-only mode.
+    - fsync: When to fsync the file: "always", "never", or every so many milliseconds.
+    - snapshot_bytes: The number of bytes appended to the file after which a new index snapshot is written in the background.
+    - metrics: A Metrics to record the time taken by commits, fsyncs, rewrites, compactions, and snapshots in, if any.
+    - shared: Whether other processes use the file at the same time.
+    - compression: The codec values are compressed with, "zlib" or "lzma", or None to store them as they are.
+    - compression_min_bytes: Values smaller than this many bytes are never compressed.
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, append_only: bool = False, compaction_threshold: float = 0.5, compaction_min_bytes: int = 2**20, fsync: str | int = "never", snapshot_bytes: int = 2**26, metrics: Metrics | None = None, shared: bool = False, compression: str | None = None, compression_min_bytes: int = 2**10):
+        assert compression is None or compression in COMPRESSION, ValueError(
+            f"compression must be None or one of {list(COMPRESSION)}, not {compression!r}")
+        assert fsync in ("always", "never") or (isinstance(fsync, (int, float)) and fsync > 0), ValueError(
+            f"fsync must be 'always', 'never', or a number of milliseconds, not {fsync!r}")
         self.path = Path(path)
         self.path.touch(exist_ok=True)
-        self.tmp_path = self.path.with_suffix(".tmp")
+        # the processes sharing a file each write their own temporary files
+        self.tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp" if shared else ".tmp")
+        self.snapshot_path = self.path.with_suffix(".idx")
+        self.append_only = append_only
+        self.compaction_threshold = compaction_threshold
+        self.compaction_min_bytes = compaction_min_bytes
+        self.fsync = fsync
+        self.snapshot_bytes = snapshot_bytes
+        self.metrics = metrics
+        self.shared = shared
+        self.compression = COMPRESSION[compression] if compression is not None else None  # codec flag of compressed values
+        self.compression_min_bytes = compression_min_bytes
+        # flocked by the processes sharing the file, see self._reading() and self._acquire_exclusive(); it outlives the file, which may be replaced
+        self._lock_fd = os.open(self.path.with_suffix(".lock"), os.O_RDWR | os.O_CREAT) if shared else None
+        self._exclusive = False  # whether this process holds the lock file exclusively
+        # guards the index and the file, the compaction thread swaps both out from under the server
+        self._lock = threading.RLock()
+        # held by the thread fsyncing the file
+        self._sync_lock = threading.Lock()
+        self._compaction_thread = None  # initialized in self._maybe_compact()
+        self._compaction_lock = threading.Lock()  # held by the thread compacting the file, see self.compact()
+        self._snapshot_thread = None  # initialized in self._maybe_snapshot()
+        self._snapshot_lock = threading.Lock()  # held while the snapshot file is written, see self.snapshot()
+        self._snapshot_seq = -1  # self._write_seq as of the last snapshot written
+        self.file_id = None  # populated by self._check_version()
+        self._snapshot_id = None  # file id and end of the records of the last snapshot, populated by self._build_index()
+        self._snapshot_end = 0
+        self._batch = threading.local()  # depth of this thread's group commit blocks, see self.group_commit()
+        self._pending = []  # blocks appended to the index but not yet written to the file
+        self._written_pos = 0  # end of the blocks written to the file, populated by self._build_index()
+        self._write_seq = 0  # number of writes to the file so far
+        self._synced_seq = 0  # number of writes known to be on disk
+        self._closed = threading.Event()
+        self.index = {}  # populated by self._build_index()
+        self.sorted_keys = []  # the keys of self.index in order, populated by self._build_index()
+        self.end_pos = 0  # size of the file (once the queued blocks are written), populated by self._build_index()
+        self.dead_bytes = 0  # bytes of superseded pairs, populated by self._build_index()
+        if shared:  # another process may be migrating or truncating the file
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        self._fd = os.open(self.path, os.O_RDWR)  # reopened whenever the file is swapped, see self._replace()
+        self._check_version()
+        self._build_index()
+        if shared:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        self._sync_thread = None
+        if fsync not in ("always", "never"):
+            self._sync_thread = threading.Thread(
+                target=self._sync_periodically, daemon=True)
+            self._sync_thread.start()
+
+    def _check_version(self) -> None:
+        """
+        Write the header of a new file, or migrate a file in an older layout to the current one. Called upon instantiation.
+        """
+        header = os.pread(self._fd, KVSTORE_DATA_START, 0)
+        if header.startswith(KVSTORE_HEADER):
+            self.file_id = header[len(KVSTORE_HEADER):]
+            return
+        if not header:  # new file
+            self.file_id = os.urandom(KVSTORE_ID_SIZE)
+            os.pwrite(self._fd, KVSTORE_HEADER + self.file_id, 0)
+            os.fsync(self._fd)
+            return
+        version = header[len(KVSTORE_MAGIC)] if header.startswith(KVSTORE_MAGIC) else 1
+        assert version < KVSTORE_VERSION, ValueError(
+            f"File {self.path} has KVStore version {version}, only versions up to {KVSTORE_VERSION} are supported.")
+        self._migrate(version)
+
+    def _migrate(self, version: int) -> None:
+        """
+        Rewrite a file in an older layout in the current one. Internal method, not to be used directly.
+
+        Version 1 files have no header, and every pair is a KEY_SIZE-byte key padded with spaces, followed by INT_SIZE bytes for the size of the value,
+        followed by the value. The keys are stripped of their padding as they are copied.
+        Version 2 files have KVSTORE_HEADER (without a file id), and every pair is a key length and value size (struct "!HI"), followed by the key and the value.
+        Version 3 files have a file id, and every pair is a checksum, key length, and value size (struct "!IHI"), followed by the key and the value; none is compressed.
+        Version 4 files have a codec flag in every record header (struct "!IBHI"), but no checksum of the header.
+        Superseded pairs and tombstones are dropped, and the checksums are recomputed for every record.
+        The new file replaces the original only once it is complete and on disk, so an interrupted migration is simply run again.
+        """
+        live = {}  # key -> (offset of value, size, codec flag)
+        with self.path.open("rb") as f_read:
+            if version == 1:
+                offset = 0
+                while key := f_read.read(KEY_SIZE):
+                    size = int.from_bytes(f_read.read(INT_SIZE), byteorder=INT_ORDER)
+                    live[key.rstrip(b" ")] = (offset + KEY_SIZE + INT_SIZE, size, 0)
+                    f_read.seek(size, 1)
+                    offset += KEY_SIZE + INT_SIZE + size
+            else:
+                old_header = struct.Struct({2: "!HI", 3: "!IHI", 4: "!IBHI"}[version])
+                offset = f_read.seek(len(KVSTORE_HEADER) + (KVSTORE_ID_SIZE if version >= 3 else 0))
+                while len(header := f_read.read(old_header.size)) == old_header.size:
+                    fields = old_header.unpack(header)
+                    key_len, size = fields[-2:]
+                    key = f_read.read(key_len)
+                    live[key] = (offset + old_header.size + key_len, size, fields[1] if version == 4 else 0)
+                    f_read.seek(size, 1)
+                    offset += old_header.size + key_len + size
+
+            file_id = os.urandom(KVSTORE_ID_SIZE)
+            with self.tmp_path.open("wb") as f_write:
+                f_write.write(KVSTORE_HEADER + file_id)
+                for key, (value_pos, size, flags) in sorted(live.items(), key=lambda item: item[1][0]):
+                    if not size:  # tombstone
+                        continue
+                    f_read.seek(value_pos)
+                    value = f_read.read(size)
+                    f_write.write(self._record_header(key, value, flags))
+                    f_write.write(value)
+                f_write.flush()
+                os.fsync(f_write.fileno())
+
+        self._replace(file_id)
+        print(f"KVSTORE: Migrated {self.path} from version {version} to version {KVSTORE_VERSION}, {offset} -> {self.path.stat().st_size} bytes")
+
+    def _replace(self, file_id: bytes) -> None:
+        """
+        Swap the temporary file in for the file, and reopen it. Internal method, not to be used directly.
+        The temporary file must be complete and on disk; the rename is made durable by fsyncing the directory.
+        The new file takes over the descriptor number of the old one, so a thread fsyncing at the same time never sees a closed descriptor.
+        """
+        os.replace(self.tmp_path, self.path)
+        dir_fd = os.open(self.path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        fd = os.open(self.path, os.O_RDWR)
+        os.dup2(fd, self._fd, inheritable=False)
+        os.close(fd)
+        self.file_id = file_id
+
+    @staticmethod
+    def _record_size(key: bytes, size: int) -> int:
+        """
+        Return the size (in bytes) of the record of a key whose value is size bytes. Internal method, not to be used directly.
+        """
+        return RECORD_HEADER.size + len(key) + size
+
+    @staticmethod
+    def _record_header(key: bytes, value: bytes | memoryview, flags: int = 0) -> bytes:
+        """
+        Return the RECORD_HEADER and key of the record of a key-value pair, whose value is compressed with the codec flags (0 if not).
+        Internal method, not to be used directly.
+        """
+        lengths = RECORD_HEADER.pack(0, flags, len(key), len(value), 0)[4:-4]
+        checksum = zlib.crc32(value, zlib.crc32(key, zlib.crc32(lengths)))
+        header = RECORD_HEADER.pack(checksum, flags, len(key), len(value), 0)[:-4]
+        return header + zlib.crc32(header).to_bytes(4, byteorder="big") + key
+
+    def _build_index(self, truncate: bool = True) -> None:
+        """
+        Load the index snapshot (see KVStore._load_snapshot), then scan the records after it and record the offset and size of every record in self.index.
+        Without a usable snapshot, the whole file is scanned.
+        Called upon instantiation (which is also how a store is recovered after a restart).
+        If a key appears more than once (append-only mode), the last pair wins and the earlier ones are counted as dead bytes.
+        A key whose last pair is a tombstone is left out of the index.
+        If the scan stops at a torn record at the end of the file, the file is truncated there (unless truncate is False, see KVStore._refresh).
+        """
+        snapshot = self._load_snapshot()
+        index, offset, dead_bytes = snapshot if snapshot is not None else ({}, KVSTORE_DATA_START, 0)
+        self._snapshot_id = self.file_id if snapshot is not None else None
+        self._snapshot_end = offset
+        with self.path.open("rb") as f:
+            self.index, self.end_pos, tail_dead_bytes = self._scan(f, offset, index)
+        self.dead_bytes = dead_bytes + tail_dead_bytes
+        file_size = os.fstat(self._fd).st_size
+        if self.end_pos < file_size and truncate:
+            print(f"KVSTORE: Discarding {file_size - self.end_pos} bytes of a torn record at the end of {self.path}")
+            os.ftruncate(self._fd, self.end_pos)
+            os.fsync(self._fd)
+        self.sorted_keys = sorted(self.index)
+        self._pending = []
+        self._written_pos = self.end_pos
+
+    def _scan(self, f, offset: int, index: dict, sorted_keys: list | None = None) -> (dict, int, int):
+        """
+        Read the records of f from offset to the end of the file into index, checking every record against its checksum.
+        Internal method, not to be used directly.
+        Return the updated index, the offset of the end of the file, and the number of dead bytes found.
+        A record whose header passes its checksum but that runs past the end of the file is a write cut short by a crash: the scan stops there,
+        so the offset returned is then the end of the last good record. A record whose header is good but whose key or value fails the record's checksum
+        is corrupt, and skipped by the sizes in its header. A record whose header is corrupt has no size that can be trusted: if a good record follows it
+        (see KVStore._next_record), it is skipped up to that record, otherwise it is torn. Skipped bytes are counted as dead bytes,
+        so a corrupt record never costs the records after it.
+        If sorted_keys is given, the keys added to or removed from index are added to or removed from it as well.
+        """
+        dead_bytes = 0
+        file_size = os.fstat(f.fileno()).st_size
+        while offset < file_size:
+            header = self._read_header(f, offset)
+            if header is None:  # cut short or corrupt, its size is unknown
+                next_offset = self._next_record(f, offset, file_size)
+                if next_offset is None:  # torn
+                    break
+                print(f"KVSTORE: Skipping {next_offset - offset} bytes of corrupt records at offset {offset} of {self.path}")
+                dead_bytes += next_offset - offset
+                offset = next_offset
+                continue
+
+            _, flags, key_len, size = header
+            if offset + RECORD_HEADER.size + key_len + size > file_size:  # torn
+                break
+            key = self._check_record(f, offset, header)
+            if key is None:
+                print(f"KVSTORE: Skipping {RECORD_HEADER.size + key_len + size} bytes of a corrupt record at offset {offset} of {self.path}")
+                dead_bytes += RECORD_HEADER.size + key_len + size
+                offset += RECORD_HEADER.size + key_len + size
+                continue
+
+            if key in index:
+                dead_bytes += self._record_size(key, index[key][1])
+                if not size and sorted_keys is not None:
+                    del sorted_keys[bisect.bisect_left(sorted_keys, key)]
+            elif size and sorted_keys is not None:
+                bisect.insort(sorted_keys, key)
+            if size:
+                index[key] = (offset, size, flags)
+            else:  # tombstone, the key was deleted
+                index.pop(key, None)
+                dead_bytes += self._record_size(key, 0)
+            offset += self._record_size(key, size)
+
+        return index, offset, dead_bytes
+
+    @staticmethod
+    def _read_header(f, offset: int) -> tuple | None:
+        """
+        Read the RECORD_HEADER of f at offset and check it against its own checksum. Internal method, not to be used directly.
+        Return the checksum of the record, its flags, key length, and value size, or None if the header is cut short or fails its checksum.
+        """
+        f.seek(offset)
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        *fields, header_checksum = RECORD_HEADER.unpack(header)
+        if zlib.crc32(header[:-4]) != header_checksum:
+            return None
+        return tuple(fields)
+
+    @staticmethod
+    def _check_record(f, offset: int, header: tuple) -> bytes | None:
+        """
+        Read the key and value of the record of f at offset, whose header (see KVStore._read_header) is good, and check them against the record's checksum.
+        Internal method, not to be used directly. The record must end within the file.
+        Return its key, or None if it fails its checksum.
+        """
+        checksum, flags, key_len, size = header
+        f.seek(offset + RECORD_HEADER.size)
+        key = f.read(key_len)
+        # the value is read in chunks, only to check it; it is only kept on a get
+        crc = zlib.crc32(key, zlib.crc32(RECORD_HEADER.pack(*header, 0)[4:-4]))
+        remaining = size
+        while remaining and (chunk := f.read(min(remaining, 2**20))):
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+        if remaining or crc != checksum:
+            return None
+        return key
+
+    def _next_record(self, f, offset: int, file_size: int) -> int | None:
+        """
+        Return the offset of the first good record of f after the bad one at offset, or None if there is none. Internal method, not to be used directly.
+        The header of the bad record is corrupt, so its sizes cannot be trusted: every offset after it is tried in turn,
+        and only the headers that could be those of a record (a known codec, a key of 1 to KEY_SIZE bytes, ending within the file,
+        passing the header checksum) are checked in full.
+        """
+        window_start = offset + 1
+        while window_start + RECORD_HEADER.size <= file_size:
+            f.seek(window_start)
+            window = f.read(2**20 + RECORD_HEADER.size)
+            for i in range(len(window) - RECORD_HEADER.size + 1):
+                *fields, header_checksum = RECORD_HEADER.unpack_from(window, i)
+                _, flags, key_len, size = fields
+                candidate = window_start + i
+                if (flags and flags not in CODECS) or not 1 <= key_len <= KEY_SIZE or candidate + RECORD_HEADER.size + key_len + size > file_size:
+                    continue
+                if zlib.crc32(window[i:i+RECORD_HEADER.size-4]) != header_checksum:
+                    continue
+                if self._check_record(f, candidate, tuple(fields)) is not None:
+                    return candidate
+            window_start += 2**20
+        return None
+
+    def _refresh(self) -> None:
+        """
+        Catch up with the writes the other processes made to a shared file. Internal method, not to be used directly.
+        The caller must hold self._lock and the lock file, so no other process is writing.
+        If the file was replaced, it is reopened and the index is rebuilt (see KVStore._build_index);
+        otherwise the records appended after self.end_pos are scanned into the index.
+        A torn record left at the end of the file is only truncated while the lock file is held exclusively; a reader leaves it out of the index,
+        and the next writer truncates it.
+        """
+        if os.stat(self.path).st_ino != os.fstat(self._fd).st_ino:
+            fd = os.open(self.path, os.O_RDWR)
+            os.dup2(fd, self._fd, inheritable=False)
+            os.close(fd)
+            self.file_id = os.pread(self._fd, KVSTORE_DATA_START, 0)[len(KVSTORE_HEADER):]
+            self._build_index(truncate=self._exclusive)
+            self._write_seq += 1
+            return
+
+        file_size = os.fstat(self._fd).st_size
+        if file_size == self.end_pos:
+            return
+        with self.path.open("rb") as f:
+            self.index, end_pos, dead_bytes = self._scan(
+                f, self.end_pos, self.index, self.sorted_keys)
+        self.dead_bytes += dead_bytes
+        self.end_pos = self._written_pos = end_pos
+        if end_pos < file_size and self._exclusive:  # left by a process that crashed while writing
+            print(f"KVSTORE: Discarding {file_size - end_pos} bytes of a torn record at the end of {self.path}")
+            os.ftruncate(self._fd, end_pos)
+
+    @contextmanager
+    def _reading(self):
+        """
+        Context manager that holds self._lock and, in shared mode, holds the lock file shared and catches up with the other processes' writes.
+        Internal method, not to be used directly.
+        A process that holds the lock file exclusively is already caught up, and keeps it.
+        """
+        with self._lock:
+            if not self.shared or self._exclusive:
+                yield
+                return
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
 
-    def get(self, key: bytes) -> dict:
+    def _acquire_exclusive(self) -> bool:
+        """
+        In shared mode, hold the lock file exclusively and catch up with the other processes' writes, before writing to the file.
+        Internal method, not to be used directly. The caller must hold self._lock.
+        Returns whether the lock was taken by this call; it is released by the next commit (see KVStore._commit).
         """
-        Navigate the file linearly and search for the key in the file. 
+        if not self.shared or self._exclusive:
+            return False
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        self._exclusive = True
+        try:
+            self._refresh()
+        except BaseException:
+            self._release_exclusive()
+            raise
+        return True
 
-        Return a dictionary with the key, value, size, start_pos, and end_pos of the key-value pair in the file.
+    def _release_exclusive(self) -> None:
+        """
+        Release the lock file, once the queued blocks are written. Internal method, not to be used directly. The caller must hold self._lock.
+        """
+        if self._exclusive:
+            self._exclusive = False
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def get(self, key: bytes, decompress: bool = True) -> dict:
+        """
+        Look up the key in the index and read its value from the file.
+
+        Return a dictionary with the key, value, size, start_pos, and end_pos of the key-value pair in the file,
+        and the flags of the codec its value is compressed with (0 if it is not).
+        A compressed value is decompressed, unless decompress is False.
 
         If the key is not found, the return dictionary's key "value" will be None.
+        The index holds exactly the live keys, so a miss is answered from memory without reading the file, and so is the existence check of a set.
 
         Requires the following parameters:
         - key: The key to search for in the file.
         """
         assert self.path.exists(), FileNotFoundError(
             f"File {self.path} has been deleted or moved.")
-        with self.path.open("rb") as f:
-            value = None
-            size = None
-            start_pos = 0
-            end_pos = 0
-            while True:
-                current_key = f.read(KEY_SIZE)
-                # if current_key is empty, we've reached the end of the file
-                if not current_key:
-                    break
-                tmp_size = f.read(INT_SIZE)
-                tmp_size_int = int.from_bytes(tmp_size, byteorder=INT_ORDER)
-                end_pos += KEY_SIZE + INT_SIZE + tmp_size_int
-                tmp_value = f.read(tmp_size_int)
-                # this block will be executed if the key is found, and then the search loop will break
-                if current_key == key:
-                    value = tmp_value
-                    size = tmp_size
-                    start_pos = end_pos - (KEY_SIZE + INT_SIZE + tmp_size_int)
-                    break
-
-        return dict(key=key, value=value, size=size, start_pos=start_pos, end_pos=end_pos)
+        value = None
+        size = None
+        start_pos = 0
+        end_pos = 0
+        flags = 0
+        with self._reading():
+            if key in self.index:
+                start_pos, size_int, flags = self.index[key]
+                end_pos = start_pos + self._record_size(key, size_int)
+                if end_pos > self._written_pos:  # still queued by a group commit
+                    self._write_pending()
+                value = os.pread(self._fd, size_int, end_pos - size_int)
+
+        if flags and decompress:
+            value = CODECS[flags].decompress(value)
+            flags = 0
+        if value is not None:
+            size = len(value).to_bytes(INT_SIZE, byteorder=INT_ORDER)
+
+        return dict(key=key, value=value, size=size, start_pos=start_pos, end_pos=end_pos, flags=flags)
 
     def set(self, key: bytes, value: bytes, size: bytes) -> bytes:
         """
@@ -422,74 +2455,498 @@ class KVStore:
 
         If the key is not found in the file, the key-value pair will be appended to the end of the file.
         If the key is found in the file at position i, the key-value pairs after i will be shifted to the left and the updated key-value pair will be written to the end of the file.
+        In append-only mode, the updated key-value pair is appended to the end of the file and the pair at position i is left behind as dead bytes.
 
         Requires the following parameters:
         - key: The key to add or update in the file.
         - value: The value to add or update in the file.
-        - size: The size of the value to add or update in the file.
+        - size: The size of the value to add or update in the file, as INT_SIZE bytes. The record is sized by the value itself, this is kept for compatibility.
 
         Returns the status of the operation: b"STORED {END}" or b"NOT STORED {END}".
+        Inside a group commit block, b"STORED {END}" only means that the pair is queued (see KVStore.group_commit).
         """
-        # used to determine whether to rewrite or append to file
-        key_response = self.get(key)
-        key_exists = key_response["value"] is not None
-        assert self.path.exists(), FileNotFoundError(
-            f"File {self.path} has been deleted or moved.")
+        if not len(value):  # an empty value would be read back as a tombstone
+            return b"NOT STORED " + END
+
+        flags = 0
+        if self.compression is not None and len(value) >= self.compression_min_bytes:
+            compressed = CODECS[self.compression].compress(value)
+            if len(compressed) < len(value):  # an incompressible value is stored as it is
+                value, flags = compressed, self.compression
 
         try:
-            if key_exists:  # trigger rewrite, key will be overwritten at bottom of file
-                if key_response["value"] != value:  # only rewrite if value is different
-                    self._rewrite(
-                        key, value, size, key_response["start_pos"], key_response["end_pos"])
+            with self._lock:
+                self._acquire_exclusive()
+                # used to determine whether to rewrite or append to file
+                key_response = self.get(key, decompress=False)
+                key_exists = key_response["value"] is not None
+                assert self.path.exists(), FileNotFoundError(
+                    f"File {self.path} has been deleted or moved.")
+
+                try:
+                    if key_exists and (key_response["value"], key_response["flags"]) == (value, flags):  # nothing to do
+                        pass
+
+                    elif key_exists and not self.append_only:  # trigger rewrite, key will be overwritten at bottom of file
+                        self._rewrite(
+                            key, value, key_response["start_pos"], key_response["end_pos"], flags)
+
+                    else:  # simply append the record to bottom of file
+                        self._append(key, value, flags)
+                        if key_exists:
+                            self.dead_bytes += key_response["end_pos"] - key_response["start_pos"]
+                            self._maybe_compact()
+
+                    status = b"STORED " + END
+
+                except Exception as e:
+                    status = b"NOT STORED " + END
+        finally:
+            # the commit also releases the lock file of a shared store, so it is made even if nothing was stored, or the set raised
+            committed = self._batching() or self._commit()
+        if not committed:
+            status = b"NOT STORED " + END
 
-            else:  # simply append key-size-value to bottom of file
-                with self.path.open("a+b") as f:
-                    line = key + size + value
-                    f.write(line)
+        return status
 
-            status = b"STORED " + END
+    def delete(self, key: bytes) -> bytes:
+        """
+        Remove a key-value pair from the file.
 
-        except Exception as e:
-            status = b"NOT STORED " + END
+        In append-only mode, a tombstone is appended to the end of the file and the pair is left behind as dead bytes.
+        Otherwise the key-value pairs after the pair are shifted to the left over it, as in KVStore._rewrite.
+
+        Returns the status of the operation: b"DELETED {END}" or b"NOT FOUND {END}".
+        """
+        try:
+            with self._lock:
+                self._acquire_exclusive()
+                status = b"NOT FOUND " + END
+                if key in self.index:
+                    start_pos, size, _ = self.index[key]
+                    end_pos = start_pos + self._record_size(key, size)
+                    if self.append_only:
+                        self._append(key, b"")
+                        self.dead_bytes += end_pos - start_pos + self._record_size(key, 0)
+                        self._maybe_compact()
+                        self.index.pop(key, None)
+                        del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+                    else:  # the rewrite drops the pair from the index
+                        self._rewrite(key, None, start_pos, end_pos)
+                    status = b"DELETED " + END
+        finally:
+            # the commit also releases the lock file of a shared store, even if the delete raised
+            if not self._batching():
+                self._commit()
 
         return status
 
-    def _rewrite(self, key: bytes, value: bytes, size: bytes, start_pos: int, end_pos: int) -> None:
+    def scan(self, start: bytes = b"", end: bytes | None = None, limit: int | None = None):
         """
-        Copy the file to a temporary file, read the key-value pairs from the tmp file after the pair to updated into the original file, overwriting the pair to be updated. 
-        Finally, append the updated key-value pair to the end of the original file.
+        Generator of the (key, value) pairs with start <= key < end (no upper bound if end is None), in key order, at most limit of them (no limit if None).
+        See prefix_range for the range of the keys that start with a prefix.
+        Keys are looked up in the sorted index a batch at a time and values are read one at a time, as they are yielded,
+        so the lock is never held for long and the pairs are never all in memory. Pairs set or deleted while iterating may or may not be seen.
         """
-        assert self.path.exists(), FileNotFoundError(
-            f"File {self.path} has been deleted or moved.")
+        count = 0
+        while limit is None or count < limit:
+            with self._reading():
+                i = bisect.bisect_left(self.sorted_keys, start)
+                batch = self.sorted_keys[i:i+100]
+            if not batch:
+                return
+
+            for key in batch:
+                if end is not None and key >= end:
+                    return
+                value = self.get(key)["value"]
+                if value is None:  # deleted since the batch was taken
+                    continue
+                yield key, value
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            # the smallest key after the batch
+            start = batch[-1] + b"\x00"
+
+    def items(self):
+        """
+        Generator of the (key, value) pairs in the file, in file order. Values are read one at a time, as they are yielded.
+        Pairs set or deleted while iterating may or may not be seen.
+        """
+        with self._reading():
+            keys = sorted(self.index, key=lambda key: self.index[key][0])
+
+        for key in keys:
+            value = self.get(key)["value"]
+            if value is not None:
+                yield key, value
+
+    @contextmanager
+    def group_commit(self):
+        """
+        Context manager that queues the sets and deletes made by this thread inside it, and commits them all at once on exit:
+        one system call writes them, and under the "always" policy one fsync makes them durable.
+        Blocks may be nested; the outermost one commits. The Server wraps every round of its event loop in one, so the sets that arrive
+        together on any of its connections are written, and fsynced, together.
+
+        Queued values are not copied, so a value that is a view of a buffer must not change until the block exits.
+        Gets see queued pairs (they are written first if need be).
 
+        Sets and deletes inside the block report success as soon as they are queued. The block yields a dictionary whose "committed" entry
+        is set on exit to whether the commit succeeded; if it did not, the queued pairs are lost (see KVStore._write_pending),
+        so a caller must check it before reporting any of them as stored.
+        """
+        if not self._batching():
+            self._batch.result = dict(committed=None)
+            self._batch.seq = self._write_seq
+        result = self._batch.result
+        self._batch.depth = getattr(self._batch, "depth", 0) + 1
         try:
-            # copy to temp file so that we can overwrite lines from the original file
-            shutil.copy(self.path, self.tmp_path)
-            # open the temp file for reading and the original file for writing
-            with self.tmp_path.open("rb") as f_read:
-                with self.path.open("r+b") as f_write:
-                    f_read.seek(end_pos)
-                    f_write.seek(start_pos)
-                    f_write.truncate()  # clear file from start_pos to end
-                    # read from temp file and write to original file
-                    while True:
-                        this_key = f_read.read(KEY_SIZE)
-                        if not this_key:
-                            break
-                        this_size = f_read.read(INT_SIZE)
-                        this_size_int = int.from_bytes(
-                            this_size, byteorder=INT_ORDER)
-                        this_value = f_read.read(this_size_int)
-                        f_write.write(this_key + this_size + this_value)
+            yield result
+        finally:
+            self._batch.depth -= 1
+            if not self._batch.depth:
+                # a block that queued and wrote nothing (the Server's rounds of gets) has nothing to commit
+                idle = not self._pending and not self._exclusive and self._write_seq == self._batch.seq
+                result["committed"] = idle or self._commit()
+
+    def _batching(self) -> bool:
+        """
+        Whether this thread is inside a group commit block. Internal method, not to be used directly.
+        """
+        return getattr(self._batch, "depth", 0) > 0
+
+    def _commit(self) -> bool:
+        """
+        Write the queued blocks and, under the "always" policy, fsync them. Internal method, not to be used directly.
+        Returns whether the writes succeeded.
+        """
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                try:
+                    self._write_pending()
+                    seq = self._write_seq
+                    self._maybe_snapshot()
+                finally:
+                    self._release_exclusive()
+            if self.fsync == "always":
+                self._sync(seq)
+        except OSError as e:
+            print(f"KVSTORE: Error committing writes: {e}")
+            return False
+        self._observe("kvstore_commit", start)
+        return True
+
+    def _observe(self, name: str, start: float) -> None:
+        """
+        Record the time since start (a time.perf_counter) in self.metrics, if there is one. Internal method, not to be used directly.
+        """
+        if self.metrics is not None:
+            self.metrics.observe(name, time.perf_counter() - start)
 
-                    # append the updated key-value pair to the end of the original file
-                    f_write.write(key + size + value)
+    def _write_pending(self) -> None:
+        """
+        Write the queued blocks at the end of the file, up to IOV_MAX of them per system call. Internal method, not to be used directly.
+        The caller must hold self._lock. If the write fails, the index is rebuilt from the file, which drops the queued pairs.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        pos = self._written_pos
+        try:
+            while pending:
+                written = os.pwritev(self._fd, pending[:IOV_MAX], pos)
+                pos += written
+                # drop the blocks written in full, and the written part of a block written in part
+                i = 0
+                while i < len(pending) and written >= len(pending[i]):
+                    written -= len(pending[i])
+                    i += 1
+                pending = pending[i:]
+                if written:
+                    pending[0] = memoryview(pending[0])[written:]
+        except OSError:
+            os.ftruncate(self._fd, self._written_pos)
+            self._build_index()
+            raise
+        self._written_pos = pos
+        self._write_seq += 1
+
+    def _sync(self, seq: int) -> None:
+        """
+        Fsync the file, unless the write numbered seq is already on disk. Internal method, not to be used directly.
+        Every write made before the fsync starts is covered by it, so threads that wait here while another thread fsyncs usually find
+        their writes covered and return at once: concurrent commits share one fsync.
+        """
+        with self._sync_lock:
+            if self._synced_seq >= seq:
+                return
+            seq = self._write_seq
+            start = time.perf_counter()
+            os.fsync(self._fd)
+            self._observe("kvstore_fsync", start)
+            self._synced_seq = seq
+
+    def _sync_periodically(self) -> None:
+        """
+        Fsync the file every self.fsync milliseconds until the store is closed. Run in a background thread.
+        """
+        while not self._closed.wait(self.fsync / 1000):
+            try:
+                self._sync(self._write_seq)
+            except OSError as e:
+                print(f"KVSTORE: Error syncing file: {e}")
 
-            # delete the temp file
-            self.tmp_path.unlink()
+    def _append(self, key: bytes, value: bytes, flags: int = 0) -> None:
+        """
+        Queue a record at the end of the file and point the index at it. Internal method, not to be used directly.
+        The record is written by the next commit (see KVStore.group_commit).
+        """
+        offset = self.end_pos
+        # value may be a view of a receive buffer, so it is queued as is rather than concatenated
+        self._pending += (self._record_header(key, value, flags), value)
+        if key not in self.index:
+            bisect.insort(self.sorted_keys, key)
+        self.index[key] = (offset, len(value), flags)
+        self.end_pos = offset + self._record_size(key, len(value))
+
+    def _rewrite(self, key: bytes, value: bytes, start_pos: int, end_pos: int, flags: int = 0) -> None:
+        """
+        Write the file to the temporary file without the pair between start_pos and end_pos: the records before it are copied as they are,
+        and the records after it are shifted to the left over it. Finally, append the updated key-value pair to the end of the temporary file
+        (unless value is None, which deletes the pair).
+        The temporary file is then swapped in for the original file (see KVStore._replace), so a crash during a rewrite leaves the original file as it was.
+        The index entries of every shifted pair are updated once the new file is in place, and a snapshot of the new index is written (see KVStore.snapshot):
+        the new file id invalidates the previous snapshot, and without one a restart would have to scan the whole file.
+        The records after it are found through the index rather than their headers, so the corrupt records skipped by KVStore._scan are dropped.
+        """
+        assert self.path.exists(), FileNotFoundError(
+            f"File {self.path} has been deleted or moved.")
+
+        start = time.perf_counter()
+        try:
+            # the queued blocks must be in the file before it is copied
+            self._write_pending()
+            shifted = {}
+            file_id = os.urandom(KVSTORE_ID_SIZE)
+            with self.path.open("rb") as f_read:
+                with self.tmp_path.open("wb") as f_write:
+                    f_write.write(KVSTORE_HEADER + file_id)
+                    f_read.seek(KVSTORE_DATA_START)
+                    remaining = start_pos - KVSTORE_DATA_START
+                    while remaining and (chunk := f_read.read(min(remaining, 2**20))):
+                        f_write.write(chunk)
+                        remaining -= len(chunk)
+                    after = sorted((entry, this_key) for this_key, entry in self.index.items() if entry[0] >= end_pos)
+                    for (this_pos, this_size, this_flags), this_key in after:
+                        f_read.seek(this_pos)
+                        shifted[this_key] = (f_write.tell(), this_size, this_flags)
+                        f_write.write(f_read.read(self._record_size(this_key, this_size)))
+                    # the bytes after the pair that were not shifted are those of corrupt records
+                    dropped = self.end_pos - end_pos - (f_write.tell() - start_pos)
+
+                    # append the updated key-value pair to the end of the temporary file
+                    if value is not None:
+                        shifted[key] = (f_write.tell(), len(value), flags)
+                        f_write.write(self._record_header(key, value, flags))
+                        f_write.write(value)
+                    new_end = f_write.tell()
+                    f_write.flush()
+                    os.fsync(f_write.fileno())
+
+            self._replace(file_id)
+            self.index.update(shifted)
+            if value is None:
+                del self.index[key]
+                del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+            self.dead_bytes -= dropped
+            self.end_pos = self._written_pos = new_end
+            self._write_seq += 1
+            self._synced_seq = self._write_seq
+            self._observe("kvstore_rewrite", start)
 
         except Exception as e:
             print(f"KVSTORE: Error rewriting file: {e}")
+            # the original file is untouched, and so is the index
+            self.tmp_path.unlink(missing_ok=True)
+            raise
+
+        try:
+            # the new file is already on disk, so this only writes the index
+            self.snapshot()
+        except OSError as e:  # the rewrite stands, a restart scans the whole file instead
+            print(f"KVSTORE: Error writing snapshot: {e}")
+
+    def _maybe_compact(self) -> None:
+        """
+        Start a background compaction if the dead bytes have passed the threshold and no compaction is already running.
+        """
+        if self.end_pos < self.compaction_min_bytes or self.dead_bytes < self.compaction_threshold * self.end_pos:
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        self._compaction_thread = threading.Thread(
+            target=self.compact, daemon=True)
+        self._compaction_thread.start()
+
+    def compact(self) -> None:
+        """
+        Write the live key-value pairs to the temporary file and swap it in for the original file, dropping all dead bytes.
+
+        The bulk of the copy happens without holding the lock, so gets and sets are served while it runs.
+        Pairs appended during the copy are carried over (and indexed) under the lock just before the files are swapped.
+        Compactions never overlap (they share the temporary file): one started while another is running waits for it, then compacts what is left.
+        """
+        with self._compaction_lock:
+            start = time.perf_counter()
+            with self._lock:
+                acquired = self._acquire_exclusive()
+                try:
+                    self._write_pending()
+                    live = sorted(self.index.items(), key=lambda item: item[1][0])
+                    copied_end = self.end_pos
+                    file_ino = os.fstat(self._fd).st_ino
+                finally:
+                    if acquired:
+                        self._release_exclusive()
+
+            try:
+                index = {}
+                with self.path.open("rb") as f_read:
+                    file_id = os.urandom(KVSTORE_ID_SIZE)
+                    with self.tmp_path.open("wb") as f_write:
+                        f_write.write(KVSTORE_HEADER + file_id)
+                        for key, (offset, size, flags) in live:
+                            f_read.seek(offset)
+                            index[key] = (f_write.tell(), size, flags)
+                            f_write.write(f_read.read(self._record_size(key, size)))
+
+                        with self._lock:
+                            acquired = self._acquire_exclusive()
+                            try:
+                                if os.fstat(self._fd).st_ino != file_ino:
+                                    # another process sharing the file replaced it since the copy started, this copy is stale
+                                    self.tmp_path.unlink()
+                                    return
+                                # carry over the pairs appended since the copy started
+                                self._write_pending()
+                                tail_start = f_write.tell()
+                                f_read.seek(copied_end)
+                                shutil.copyfileobj(f_read, f_write)
+                                f_write.flush()
+                                # whatever the policy, the compacted file must be on disk before it replaces the original
+                                os.fsync(f_write.fileno())
+                                with self.tmp_path.open("rb") as f_tail:
+                                    index, end_pos, dead_bytes = self._scan(
+                                        f_tail, tail_start, index)
+                                self._replace(file_id)
+                                self.index = index
+                                self.end_pos = self._written_pos = end_pos
+                                self.dead_bytes = dead_bytes
+                                # a new file is a new write, so the snapshots of the old one are older (see self.snapshot())
+                                self._write_seq += 1
+                                self._synced_seq = self._write_seq
+                            finally:
+                                if acquired:
+                                    self._release_exclusive()
+                self._observe("kvstore_compact", start)
+
+            except Exception as e:
+                print(f"KVSTORE: Error compacting file: {e}")
+                self.tmp_path.unlink(missing_ok=True)
+
+    def _maybe_snapshot(self) -> None:
+        """
+        Start a background snapshot if snapshot_bytes have been appended since the last one and no snapshot is already running.
+        """
+        last_end = self._snapshot_end if self._snapshot_id == self.file_id else KVSTORE_DATA_START
+        if self.end_pos - last_end < self.snapshot_bytes:
+            return
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        self._snapshot_thread = threading.Thread(
+            target=self.snapshot, daemon=True)
+        self._snapshot_thread.start()
+
+    def snapshot(self) -> None:
+        """
+        Write the index to the snapshot file, so that the next instantiation only scans the records appended after this point.
+
+        The records the snapshot points at are fsynced before it is written. The snapshot is written to a temporary file and swapped in,
+        and it ends with a checksum of its contents, so a torn or corrupt snapshot is never loaded (the whole file is scanned instead).
+        The index is copied under the lock, the rest happens without holding it. Snapshots taken at the same time are written one at a time,
+        and one older than the snapshot already written is dropped.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            self._write_pending()
+            entries = list(self.index.items())
+            file_id, end_pos, dead_bytes, seq = self.file_id, self.end_pos, self.dead_bytes, self._write_seq
+        self._sync(seq)
+
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, KVSTORE_VERSION,
+                                      file_id, end_pos, dead_bytes, len(entries))]
+        parts += (SNAPSHOT_ENTRY.pack(len(key), offset, size, flags) + key
+                  for key, (offset, size, flags) in entries)
+        data = b"".join(parts)
+        tmp_path = self.tmp_path.with_suffix(".idx.tmp")
+        with self._snapshot_lock:
+            if seq <= self._snapshot_seq:
+                return
+            with tmp_path.open("wb") as f:
+                f.write(data)
+                f.write(zlib.crc32(data).to_bytes(4, byteorder="big"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            self._snapshot_id, self._snapshot_end, self._snapshot_seq = file_id, end_pos, seq
+        self._observe("kvstore_snapshot", start)
+
+    def _load_snapshot(self) -> tuple | None:
+        """
+        Read the index snapshot. Internal method, not to be used directly.
+        Return the index, the end of the records it covers, and the number of dead bytes in them,
+        or None if there is no snapshot, it is corrupt, or it was taken of another file (see KVStore.snapshot).
+        """
+        try:
+            data = self.snapshot_path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if len(data) < SNAPSHOT_HEADER.size + 4 or zlib.crc32(data[:-4]) != int.from_bytes(data[-4:], byteorder="big"):
+            return None
+        magic, version, file_id, end_pos, dead_bytes, count = SNAPSHOT_HEADER.unpack_from(data)
+        if (magic, version, file_id) != (SNAPSHOT_MAGIC, KVSTORE_VERSION, self.file_id) or end_pos > os.fstat(self._fd).st_size:
+            return None
+
+        index = {}
+        pos = SNAPSHOT_HEADER.size
+        for _ in range(count):
+            key_len, offset, size, flags = SNAPSHOT_ENTRY.unpack_from(data, pos)
+            pos += SNAPSHOT_ENTRY.size
+            index[data[pos:pos+key_len]] = (offset, size, flags)
+            pos += key_len
+
+        return index, end_pos, dead_bytes
+
+    def close(self) -> None:
+        """
+        Wait for the background threads to finish, write the queued blocks and a snapshot of the index (which fsyncs the file), and close the file.
+        """
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        self.snapshot()
+        os.close(self._fd)
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
 
     def __str__(self) -> str:
         assert self.path.exists(), FileNotFoundError(
@@ -498,17 +2955,22 @@ class KVStore:
         lines = []
         max_int_digits = 0
         empty = True
-        # read the file and store the key, size, and value of each key-value pair in a list
-        with self.path.open("rb") as f:
+        # read the file and store the key, size, and value of each live key-value pair in a list
+        with self._reading(), self.path.open("rb") as f:
+            self._write_pending()
+            f.seek(KVSTORE_DATA_START)
             while True:
-                key = f.read(KEY_SIZE)
-                if not key:
+                offset = f.tell()
+                header = f.read(RECORD_HEADER.size)
+                if not header:
                     break
-                size = f.read(INT_SIZE)
-                size_int = int.from_bytes(size, byteorder=INT_ORDER)
+                _, _, key_len, size_int, _ = RECORD_HEADER.unpack(header)
+                key = f.read(key_len)
+                value = f.read(size_int)
+                if self.index.get(key, (None,))[0] != offset:  # superseded pair (append-only mode)
+                    continue
                 int_digits = len(str(size_int))
                 max_int_digits = int_digits if int_digits > max_int_digits else max_int_digits
-                value = f.read(size_int)
                 lines.append((key, size_int, value))
                 empty = False
 
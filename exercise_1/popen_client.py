@@ -9,12 +9,14 @@ PORT = int(client_info["PORT"])
 vocal = client_info["vocal"]
 id = client_info["id"]
 instructions = client_info["instructions"]
+binary = client_info.get("binary", False)
 
 client = Client(
     HOST=HOST,
     PORT=PORT,
     connection_timeout=60,
-    vocal=vocal
+    vocal=vocal,
+    binary=binary
 )
 
 # execute instructions
@@ -25,29 +27,63 @@ client = Client(
 def lsplit_bytes(s, c, n): return [x[::-1] for x in s[::-1].rsplit(c, n)[::-1]]
 
 
-for i, instruction in enumerate(instructions):
+def parse(instruction):
+    """
+    Return the type of an instruction ("get", "set", "scan" or "stats") and its key (and value) as bytes.
+    A scan instruction's key is the prefix of the keys to scan, every key if there is none.
+    """
     if instruction.startswith("get"):
         parts = lsplit_bytes(instruction, " ", 1)
-        bparts = [p.encode("utf-8") for p in parts]
-        status, response, end = client.get(key=bparts[1])
-        if status == b"KEY NOT FOUND " + END:
-            response = "KEY NOT FOUND \r\n"
+        return "get", [p.encode("utf-8") for p in parts[1:]]
+
+    if instruction.startswith("scan"):
+        parts = lsplit_bytes(instruction, " ", 1)
+        return "scan", [p.encode("utf-8") for p in parts[1:]]
+
+    if instruction == "stats":
+        return "stats", []
+
+    # anything else is treated as a set
+    parts = lsplit_bytes(instruction, " ", 2)
+    return "set", [p.encode("utf-8") for p in parts[1:]]
+
+
+# consecutive get or set instructions are sent to the server as one batch, scans and stats on their own
+batch = []
+for i, instruction in enumerate(instructions):
+    req_type, args = parse(instruction)
+    if req_type == "scan":
+        pairs = list(client.scan(prefix=args[0] if args else None))
         print(
-            f"CLIENT{id}: {i}th instruction {instruction!r} received response: {status, response, end}")
+            f"CLIENT{id}: {i}th instruction {instruction!r} received response: {pairs!r}")
+        continue
 
-    elif instruction.startswith("set"):
-        parts = lsplit_bytes(instruction, " ", 2)
-        bparts = [p.encode("utf-8") for p in parts]
-        response = client.set(key=bparts[1], value=bparts[2])
+    if req_type == "stats":
+        # the latencies depend on the machine, only the counters are printed
+        stats = {name: value for name, value in client.stats().items() if not name.endswith("_us")}
         print(
-            f"CLIENT{id}: {i}th instruction {instruction!r} received response: {response!r}")
+            f"CLIENT{id}: {i}th instruction {instruction!r} received response: {stats!r}")
+        continue
+
+    batch.append((i, instruction, req_type, args))
+    if i + 1 < len(instructions) and parse(instructions[i + 1])[0] == batch[0][2]:
+        continue
+
+    if batch[0][2] == "get":
+        values = client.get_many(keys=[args[0] for _, _, _, args in batch])
+        for i, instruction, _, args in batch:
+            response = values.get(args[0], "KEY NOT FOUND \r\n")
+            print(
+                f"CLIENT{id}: {i}th instruction {instruction!r} received response: {response!r}")
 
     else:
-        parts = lsplit_bytes(instruction, " ", 2)
-        bparts = [p.encode("utf-8") for p in parts]
-        response = client.set(key=bparts[1], value=bparts[2])
-        print(
-            f"CLIENT{id}: {i}th instruction {instruction!r} received response: {response!r}")
+        statuses = client.set_many(
+            items=[(args[0], args[1]) for _, _, _, args in batch])
+        for (i, instruction, _, _), status in zip(batch, statuses):
+            print(
+                f"CLIENT{id}: {i}th instruction {instruction!r} received response: {status!r}")
+
+    batch = []
 
 # close connection
 client.close()
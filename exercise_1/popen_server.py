@@ -1,6 +1,7 @@
 from core import *
 import json
 import sys
+import multiprocessing
 
 server_info = json.loads(sys.argv[1])
 HOST = server_info["HOST"]
@@ -8,16 +9,52 @@ PORT = int(server_info["PORT"])
 timeout = int(server_info["timeout"])
 backlog = int(server_info["backlog"])
 kvstore_path = server_info["kvstore_path"]
+append_only = server_info.get("append_only", False)
+compaction_threshold = float(server_info.get("compaction_threshold", 0.5))
+cache_size = int(server_info.get("cache_size", 0))
+# replicas are given as [HOST, PORT] pairs
+replicas = [tuple(node) for node in server_info.get("replicas", [])]
+replication = server_info.get("replication", "async")
+# "always", "never", or a number of milliseconds between fsyncs
+fsync = server_info.get("fsync", "never")
+# "zlib", "lzma", or None to store values uncompressed
+compression = server_info.get("compression")
+compression_min_bytes = int(server_info.get("compression_min_bytes", 2**10))
+# number of worker processes sharing the port and the kvstore file, see Server
+workers = int(server_info.get("workers", 1))
 
-serv = Server(
-    HOST=HOST,
-    PORT=PORT,
-    timeout=timeout,
-    backlog=backlog,
-    kvstore_path=kvstore_path,
-)
 
-print(f"Server: Listening on {HOST}:{PORT}...")
-serv.listen()
-print(f"Server: Detached from {HOST}:{PORT}")
-serv.close()
+def serve(shared: bool) -> None:
+    serv = Server(
+        HOST=HOST,
+        PORT=PORT,
+        timeout=timeout,
+        backlog=backlog,
+        kvstore_path=kvstore_path,
+        append_only=append_only,
+        compaction_threshold=compaction_threshold,
+        cache_size=cache_size,
+        replicas=replicas,
+        replication=replication,
+        fsync=fsync,
+        shared=shared,
+        compression=compression,
+        compression_min_bytes=compression_min_bytes,
+    )
+
+    print(f"Server: Listening on {HOST}:{PORT}...")
+    serv.listen()
+    print(f"Server: Detached from {HOST}:{PORT}")
+    serv.close()
+
+
+if workers == 1:
+    serve(shared=False)
+else:
+    # pre-fork the workers, each with its own listening socket on the port
+    context = multiprocessing.get_context("fork")
+    procs = [context.Process(target=serve, args=(True,)) for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
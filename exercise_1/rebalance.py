@@ -0,0 +1,20 @@
+from core import *
+import json
+import sys
+
+rebalance_info = json.loads(sys.argv[1])
+# nodes are given as "HOST:PORT" strings, since JSON has no tuples
+def parse_node(node): return (node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1]))
+
+
+old_nodes = [parse_node(node) for node in rebalance_info["old_nodes"]]
+new_nodes = [parse_node(node) for node in rebalance_info["new_nodes"]]
+kvstore_paths = {parse_node(node): path for node,
+                 path in rebalance_info["kvstore_paths"].items()}
+vnodes = int(rebalance_info.get("vnodes", 100))
+compression = rebalance_info.get("compression")
+
+moved = rebalance(old_nodes, new_nodes, kvstore_paths, vnodes, compression=compression)
+for (source, destination), n in moved.items():
+    print(
+        f"Rebalance: {n} pairs moved from {source[0]}:{source[1]} to {destination[0]}:{destination[1]}")
@@ -14,6 +14,7 @@ def main(test_num, server_info):
     PORT = int(server_info["PORT"])
     def set(key, value): return f"set {key} {value}"
     def get(key): return f"get {key}"
+    def scan(prefix=""): return f"scan {prefix}".rstrip()
     procs = []
 
     match test_num:
@@ -145,6 +146,107 @@ def main(test_num, server_info):
                 ["python", "popen_client.py", json.dumps(client_info)])
             procs.append(client_proc)
 
+        case 6:
+            # open server
+            server_proc = subprocess.Popen(
+                ["python", "popen_server.py", json.dumps(server_info)], close_fds=True)
+            procs.append(server_proc)
+
+            time.sleep(1)
+
+            # prepare client instructions, over the binary protocol
+            base_client_info = dict(HOST=HOST, PORT=PORT, vocal=True, binary=True)
+            client_info = {
+                **base_client_info,
+                "id": 1,
+                "instructions": [
+                    get("name"),  # key doesn't exist yet
+                    set("name", "John Doe"),
+                    get("name"),
+                    set("name", "Jane Doe"),
+                    set("age", 30),
+                    get("name"),
+                    get("age"),
+                ]
+            }
+
+            client_proc = subprocess.Popen(
+                ["python", "popen_client.py", json.dumps(client_info)])
+            procs.append(client_proc)
+
+        case 7:
+            # open server
+            server_proc = subprocess.Popen(
+                ["python", "popen_server.py", json.dumps(server_info)], close_fds=True)
+            procs.append(server_proc)
+
+            time.sleep(1)
+
+            # prepare client instructions (scans, in key order)
+            base_client_info = dict(HOST=HOST, PORT=PORT, vocal=True)
+            client_info = {
+                **base_client_info,
+                "id": 1,
+                "instructions": [
+                    set("user:2", "Jane Doe"),
+                    set("item:1", "book"),
+                    set("user:1", "John Doe"),
+                    set("user:10", "Josh"),
+                    scan("user:"),
+                    scan("nobody:"),  # no key has the prefix
+                    scan(),
+                ]
+            }
+
+            client_proc = subprocess.Popen(
+                ["python", "popen_client.py", json.dumps(client_info)])
+            procs.append(client_proc)
+            client_proc.wait()
+
+            # the same scans over the binary protocol
+            client_info = {
+                **base_client_info,
+                "id": 2,
+                "binary": True,
+                "instructions": [
+                    scan("user:"),
+                    scan("nobody:"),
+                    scan(),
+                ]
+            }
+
+            client_proc = subprocess.Popen(
+                ["python", "popen_client.py", json.dumps(client_info)])
+            procs.append(client_proc)
+
+        case 8:
+            # open server
+            server_proc = subprocess.Popen(
+                ["python", "popen_server.py", json.dumps(server_info)], close_fds=True)
+            procs.append(server_proc)
+
+            time.sleep(1)
+
+            # prepare client instructions (stats count the requests made before them)
+            base_client_info = dict(HOST=HOST, PORT=PORT, vocal=True)
+            for i, binary in enumerate((False, True), start=1):
+                client_info = {
+                    **base_client_info,
+                    "id": i,
+                    "binary": binary,
+                    "instructions": [
+                        set("name", "John Doe"),
+                        get("name"),
+                        get("age"),  # a miss
+                        "stats",
+                    ]
+                }
+
+                client_proc = subprocess.Popen(
+                    ["python", "popen_client.py", json.dumps(client_info)])
+                procs.append(client_proc)
+                client_proc.wait()
+
     # fix so that server and client processes are killed, not useful for actual memcache server
     while True:
         time.sleep(1)
@@ -1,28 +1,44 @@
 from pathlib import Path
 import socket
+import selectors
+import struct
 import json
 import time
-from math import log10, ceil
+import heapq
+from collections import deque
+
+# "lamport": a message is delivered once every process has acked it
+# "sequencer": the process with the lowest port numbers every message, the others deliver in that order
+ORDERINGS = ("lamport", "sequencer")
+
+# kinds of message
+DATA, ACK, APP, SEQ = range(4)
+# every message starts with its kind, the sender PID, its TS and the length of its body
+# the header also frames the message, so many messages can share one long-lived connection
+MESSAGE_HEADER = struct.Struct("!BHQI")
+ACK_ENTRY = struct.Struct("!HQ")  # body of an ack is a run of (sender PID, TS acked up to)
+SEQ_NUMBER = struct.Struct("!Q")  # body of a sequenced message starts with its sequence number
 
 
 class Message:
-    def __init__(self, PID: None, TS: None, body: None):
+    def __init__(self, PID: None, TS: None, body: None, kind: int = DATA):
         """
         If an empty message is created, it is assumed that it is will be populated by decoded a recieved message
+        TS is an integer counter, ties between counters are broken by PID
+        body is bytes, or a memoryview into the buffer the message was received in
         """
+        self.kind = kind
         self.PID = PID
         self.TS = TS
         self.body = body
 
-    def encode(self):
-        return f"{self.PID}-{self.TS}-{self.body}".encode("utf-8")
+    def encode(self) -> bytes:
+        return MESSAGE_HEADER.pack(self.kind, self.PID, self.TS, len(self.body)) + self.body
 
-    def decode(self, msg: bytes):
-        msg = msg.decode("utf-8")
-        parts = msg.split("-")
-        self.PID = int(parts[0])
-        self.TS = float(parts[1])
-        self.body = "-".join(parts[2:])  # body could include dashes
+    def decode(self, msg: memoryview):
+        self.kind, self.PID, self.TS, size = MESSAGE_HEADER.unpack_from(msg)
+        # slicing a memoryview doesn't copy the body
+        self.body = msg[MESSAGE_HEADER.size:MESSAGE_HEADER.size+size]
 
     def __lt__(self, other: "Message"):
         if self.TS < other.TS:
@@ -33,41 +49,68 @@ class Message:
             return False
 
     def __str__(self):
-        return f"{self.PID}-{self.TS}-{self.body}"
+        return f"{self.PID}-{self.TS}-{str(self.body, 'utf-8')}"
 
 
 class MessageQueue:
     def __init__(self):
+        # heap of (TS, PID, msg) entries, so the head is always the message with the smallest (TS, PID)
         self.queue = []
-        # keys will be f"{PID}-{TS}" (sender PID and send timestamp) and values will be a set of PIDs that have acked the message
+        # keys will be (PID, TS) (sender PID and send timestamp) and values will be the number of processes that have acked the message
         self.acks = {}
+        # sender PID -> TS of its queued messages, in the order they arrived (which is increasing TS, connections are FIFO)
+        self.by_sender = {}
+        # sender PID -> {acker PID -> highest TS of the sender acked by the acker}
+        self.acked_upto = {}
 
-    def enqueue(self, msg: Message, already_acked: bool = False):
+    def enqueue(self, msg: Message):
         """
         Because enqueue will only be called upon receiving a msg which is not an ack (which only happens once), we can assume that the message is not already in the queue
+        The message counts as acked by its sender. Cumulative acks may have covered it before it arrived, they are already counted
         """
-        self.queue.append(msg)
-        self.queue.sort()
-        if not already_acked:
-            self.acks[f"{msg.PID}-{msg.TS}"] = set((msg.PID,))
+        heapq.heappush(self.queue, (msg.TS, msg.PID, msg))
+        self.by_sender.setdefault(msg.PID, deque()).append(msg.TS)
+        self.acks[(msg.PID, msg.TS)] = 1 + sum(
+            TS >= msg.TS for TS in self.acked_upto.get(msg.PID, {}).values())
 
-        else:
-            self.acks[f"{msg.PID}-{msg.TS}"].add(msg.PID)
+    def ack(self, acker: int, PID: int, TS: int):
+        """
+        Cumulative ack: acker has received every message from PID up to TS.
+        Connections are FIFO, so this holds as soon as acker has received the message (PID, TS) itself
+        """
+        acked = self.acked_upto.setdefault(PID, {})
+        prev = acked.get(acker, -1)
+        if TS <= prev:
+            return
+        acked[acker] = TS
+        # only the queued messages the ack newly covers gain an ack
+        for queued_TS in self.by_sender.get(PID, ()):
+            if queued_TS > TS:
+                break
+            if queued_TS > prev:
+                self.acks[(PID, queued_TS)] += 1
+
+    def n_acks(self, msg: Message) -> int:
+        return self.acks.get((msg.PID, msg.TS), 0)
 
     def dequeue(self) -> Message:
-        return self.queue.pop(0)
+        _, _, msg = heapq.heappop(self.queue)
+        # the head is the oldest queued message of its sender
+        self.by_sender[msg.PID].popleft()
+        del self.acks[(msg.PID, msg.TS)]
+        return msg
 
     def peek(self) -> Message:
-        return self.queue[0]
+        return self.queue[0][2]
 
-    def sort(self):
-        self.queue.sort()
+    def __len__(self):
+        return len(self.queue)
 
     def __str__(self):
         s = "Queue state\n-----------\n"
-        for i, msg in enumerate(self.queue):
+        for i, (_, _, msg) in enumerate(sorted(self.queue)):
             s += f"Queue[{i}]\n"
-            s += f"Acks: {self.acks[f'{msg.PID}-{msg.TS}']}\n"
+            s += f"Acks: {self.n_acks(msg)}\n"
             s += str(msg) + "\n"*((i != len(self.queue)-1) + 1)
 
         if len(self.queue) == 0:
@@ -78,7 +121,8 @@ class MessageQueue:
 
 
 class Process:
-    def __init__(self, config_index: int, config_file: Path, timeout: int = 30):
+    def __init__(self, config_index: int, config_file: Path, timeout: int = 30, ack_delay: float = 0.005, ordering: str = "lamport"):
+        assert ordering in ORDERINGS, f"ordering must be one of {ORDERINGS}"
         config = self._load_config(config_file)
         # PID is also the port number
         self.PID = config[f"{config_index}"]["port"]
@@ -86,7 +130,7 @@ class Process:
         self.party = [port for port in [val["port"]
                                         for val in config.values()]]
         # starting timestamp doesn't matter
-        self.TS = 0.
+        self.TS = 0
         self.queue = MessageQueue()
         self.delivered_msgs = set()
         # create socket
@@ -94,34 +138,91 @@ class Process:
         # allow reuse of socket
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.s.bind(("127.0.0.1", self.PID))
+        self.s.setblocking(False)
         self.timeout = timeout
-        self.s.settimeout(self.timeout)
-        self.conn = None
-        self.addr = None
+        # one selector multiplexes the listening socket, the connections from peers (and the app), and the connections to peers
+        self.selector = selectors.DefaultSelector()
+        self.inbufs = {}  # incoming socket -> bytes of an incomplete message, received but not yet handled
+        self.peers = {}  # peer PID -> outgoing socket, opened once at startup and kept open
+        self.outbufs = {}  # peer PID -> framed messages not yet sent
+        self.last_recv = None  # time the last message arrived, set in main_loop()
+        # acks are cumulative and batched: sender PID -> highest TS received from it and not yet acked
+        # they ride along with the next message this process broadcasts, or go out on their own after ack_delay seconds
+        self.pending_acks = {}
+        self.ack_delay = ack_delay
+        self.ack_deadline = None
+        self.ordering = ordering
+        self.sequencer = min(self.party)
+        self.n_sequenced = 0  # number of messages the sequencer has numbered so far
+        self.next_seq = 0  # sequence number of the next message to deliver
+        self.sequenced = {}  # sequence number -> message, held back until every lower number is delivered
 
         self.main_loop()
 
     def main_loop(self):
         self.s.listen(100)
+        self.selector.register(self.s, selectors.EVENT_READ)
+        self._connect_to_party()
+        # the process times out once no message has arrived for self.timeout seconds, peers closing their connections don't count
+        self.last_recv = time.time()
         while True:
-            try:
-                self.conn, self.addr = self.s.accept()
-                with self.conn:
-                    # print(f"Connected by {self.addr}")
-                    parts = []
-                    while True:
-                        part = self.conn.recv(1024)
-                        if not part:
-                            break
-                        parts.append(part)
-                raw_msg = b"".join(parts)
-                msg = Message(None, None, None)
-                msg.decode(raw_msg)
-                # print(f"Process {self.PID} received message: {msg}") #$
-                self._handle_receive(msg)
-            except socket.timeout:
+            remaining = self.last_recv + self.timeout - time.time()
+            if remaining <= 0:
                 print(f"Process {self.PID} timed out")
+                if self.sequenced:
+                    print(
+                        f"Process {self.PID} never received message {self.next_seq}, {len(self.sequenced)} later messages were not delivered")
+                break
+            if self.ack_deadline is not None:
+                remaining = min(remaining, max(0., self.ack_deadline - time.time()))
+            events = self.selector.select(timeout=remaining)
+            for key, mask in events:
+                if key.fileobj is self.s:
+                    conn, _ = self.s.accept()
+                    conn.setblocking(False)
+                    self.inbufs[conn] = b""
+                    self.selector.register(conn, selectors.EVENT_READ)
+                elif key.data is not None:  # outgoing socket to peer key.data is writable again
+                    self._flush(key.data)
+                else:
+                    self._recv(key.fileobj)
+            if self.ack_deadline is not None and time.time() >= self.ack_deadline:
+                self.broadcast(self._ack_msg())
+        self._close()
+
+    def _recv(self, conn: socket.socket):
+        try:
+            data = conn.recv(65536)
+        except ConnectionError:
+            data = b""
+        if not data:  # peer (or app) is done
+            self.selector.unregister(conn)
+            del self.inbufs[conn]
+            conn.close()
+            return
+        # bytes, not a growing bytearray: the bodies of the messages are views into it and must stay valid
+        data = self.inbufs[conn] + data
+        view = memoryview(data)
+
+        # handle every complete message, the rest waits for the next recv
+        start = 0
+        while len(data) - start >= MESSAGE_HEADER.size:
+            *_, size = MESSAGE_HEADER.unpack_from(data, start)
+            end = start + MESSAGE_HEADER.size + size
+            if len(data) < end:
                 break
+            msg = Message(None, None, None)
+            msg.decode(view[start:end])
+            start = end
+            self.last_recv = time.time()
+            # print(f"Process {self.PID} received message: {msg}") #$
+            self._handle_receive(msg)
+        self.inbufs[conn] = data[start:]
+
+    def _close(self):
+        for sock in [*self.inbufs, *self.peers.values(), self.s]:
+            sock.close()
+        self.selector.close()
 
     def _load_config(self, config_file: Path) -> dict:
         # Load config file and return dictionary of process IDs and ports
@@ -134,17 +235,48 @@ class Process:
     def broadcast(self, msg: Message):
         assert isinstance(msg, Message), "msg must be of type Message"
         self.logical_clock()
-        if msg.body[:4] != "ack:":
+        if self.ordering == "sequencer":  # the sequencer forwards the message to the party
+            if self.PID == self.sequencer:
+                self._sequence(msg)
+            else:
+                self._send(self.sequencer, msg.encode())
+            return
+        if msg.kind != ACK:
             self.queue.enqueue(msg)  # enqueue() handles self ack
-        self.queue.sort()
+            if self.pending_acks:  # piggyback the pending acks, both go out in the same send
+                self._send_to_all(self._ack_msg(), msg)
+                return
         self._send_to_all(msg)
 
-    def _send_to_all(self, msg: Message):
+    def _sequence(self, msg: Message):
+        # number the message and forward it, numbers are assigned in the order messages reach the sequencer
+        seq = self.n_sequenced
+        self.n_sequenced += 1
+        self.sequenced[seq] = msg
+        self._send_to_all(Message(msg.PID, msg.TS, SEQ_NUMBER.pack(seq) + msg.body, SEQ))
+        self._attempt_to_deliver()
+
+    def _ack_msg(self) -> Message:
+        # one cumulative ack for every sender heard from since the last ack
+        body = b"".join(ACK_ENTRY.pack(PID, TS) for PID, TS in self.pending_acks.items())
+        self.pending_acks.clear()
+        self.ack_deadline = None
+        return Message(self.PID, self.TS, body, ACK)
+
+    def _send_to_all(self, *msgs: Message):
+        # encode once, every peer gets the same bytes
+        data = b"".join(msg.encode() for msg in msgs)
         for process_id in self.party:
             if process_id != self.PID:  # don't send to self, handled in broadcast()
-                self._send(process_id, msg)
+                self._send(process_id, data)
+
+    def _connect_to_party(self):
+        for process_id in self.party:
+            if process_id != self.PID:
+                self.peers[process_id] = self._connect(process_id)
+                self.outbufs[process_id] = bytearray()
 
-    def _send(self, send_to_port: int, msg: Message):
+    def _connect(self, send_to_port: int) -> socket.socket:
         # create a socket object, different protocols could be used
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -165,49 +297,88 @@ class Process:
                         f"Process {self.PID} could not connect to {send_to_port}, this whole thing is gonna blow")
                     quit()
 
-        sock.sendall(msg.encode())
-        sock.close()
+        # messages are small and latency matters more than packet count
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        return sock
+
+    def _send(self, send_to_port: int, data: bytes):
+        # queue the encoded messages and send what the socket takes now, the selector flushes the rest once the peer reads
+        self.outbufs[send_to_port] += data
+        self._flush(send_to_port)
+
+    def _flush(self, send_to_port: int):
+        sock = self.peers[send_to_port]
+        buf = self.outbufs[send_to_port]
+        try:
+            sent = sock.send(buf)
+        except BlockingIOError:
+            sent = 0
+        except ConnectionError:
+            print(f"Process {self.PID} lost its connection to {send_to_port}")
+            buf.clear()
+            sent = 0
+        del buf[:sent]
+
+        # only wait for the socket to be writable while something is left to send
+        registered = sock in self.selector.get_map()
+        if buf and not registered:
+            self.selector.register(sock, selectors.EVENT_WRITE, send_to_port)
+        elif not buf and registered:
+            self.selector.unregister(sock)
 
     def _handle_receive(self, msg: Message):
-        if msg.body[:4] != "app:":  # app doesn't have timestamp, no time collision
-            if msg.TS > self.TS:
-                self.TS = msg.TS
-            elif msg.TS == self.TS:
-                # append PID to TS to break tie
-                self.TS = self.TS + (self.PID / 10**ceil(log10(self.PID)))
+        if msg.kind != APP:  # app doesn't have timestamp
+            # no tiebreak needed on the counter, (TS, PID) is unique
+            self.TS = max(self.TS, msg.TS)
 
         self.logical_clock()
 
-        if msg.body[:4] == "ack:":  # case where the message is an ack
-            acked_msg = msg.body[4:]
-            ack_PID, ack_TS = acked_msg.split("-")
-            if f"{ack_PID}-{ack_TS}" in self.queue.acks:
-                self.queue.acks[f"{ack_PID}-{ack_TS}"].add(msg.PID)
-
-            else:
-                self.queue.acks[f"{ack_PID}-{ack_TS}"] = set((msg.PID))
+        if msg.kind == ACK:  # case where the message is a (cumulative) ack
+            for ack_PID, ack_TS in ACK_ENTRY.iter_unpack(msg.body):
+                # the ack may arrive before the message itself, it is counted either way
+                self.queue.ack(msg.PID, ack_PID, ack_TS)
             self._attempt_to_deliver()  # only need to attempt msg delivery when recv an ack
 
-        elif msg.body[:4] == "app:":  # case where the message is an application message
-            new_msg = Message(self.PID, self.TS, msg.body[4:])
+        elif msg.kind == APP:  # case where the message is an application message
+            new_msg = Message(self.PID, self.TS, msg.body)
             self.broadcast(new_msg)
 
+        elif msg.kind == SEQ:  # case where the message was numbered by the sequencer
+            (seq,) = SEQ_NUMBER.unpack_from(msg.body)
+            if seq >= self.next_seq:  # anything lower was already delivered
+                self.sequenced[seq] = Message(msg.PID, msg.TS, msg.body[SEQ_NUMBER.size:])
+            self._attempt_to_deliver()
+
+        elif self.ordering == "sequencer":  # case where the message is an original message to be numbered by this process
+            self._sequence(msg)
+
         else:  # case where the message is an original message from another process
-            self.queue.enqueue(msg, already_acked=f"{msg.PID}-{msg.TS}" in self.queue.acks)
-            self.queue.acks[f"{msg.PID}-{msg.TS}"].add(self.PID)
-            ack_msg = Message(self.PID, self.TS, f"ack:{msg.PID}-{msg.TS}")
-            self.broadcast(ack_msg)
+            self.queue.enqueue(msg)
+            self.queue.ack(self.PID, msg.PID, msg.TS)  # self ack
+            # the ack to the party is deferred, it covers every message from msg.PID up to msg.TS
+            self.pending_acks[msg.PID] = msg.TS
+            if self.ack_deadline is None:
+                self.ack_deadline = time.time() + self.ack_delay
             self._attempt_to_deliver()
 
     def _attempt_to_deliver(self):
-        head = self.queue.peek()
-        acks = self.queue.acks[f"{head.PID}-{head.TS}"]
-        if all(pid in acks for pid in self.party):
-            # actual delivery of message
-            print(f"Process {self.PID} delivering message: {head}")
-            self.logical_clock()
-            self.queue.dequeue()
-            self.delivered_msgs.add(head)  # optional, but useful for testing
+        if self.ordering == "sequencer":
+            # deliver in sequence number order, a gap holds back every later message until it is filled
+            while self.next_seq in self.sequenced:
+                self._deliver(self.sequenced.pop(self.next_seq))
+                self.next_seq += 1
+            return
+
+        # every process acks a message once (its sender by sending it), so it is acked by all once the count reaches the party size
+        while len(self.queue) and self.queue.n_acks(self.queue.peek()) == len(self.party):
+            self._deliver(self.queue.dequeue())
+
+    def _deliver(self, head: Message):
+        # actual delivery of message
+        print(f"Process {self.PID} delivering message: {head}")
+        self.logical_clock()
+        self.delivered_msgs.add(head)  # optional, but useful for testing
 
 
 class Application:
@@ -222,28 +393,29 @@ class Application:
     def _main_loop(self):
         # create a socket object, different protocols could be used
         if self.messages:
+            # one connection carries every message of the app
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            start = time.time()
+            while time.time() < start + self.timeout:
+                try:
+                    # connect this socket to established server
+                    sock.connect(("127.0.0.1", self.middleware_PID))
+                    break
+
+                except ConnectionRefusedError as e:  # if server is not listening, wait 5 seconds and try again
+                    if time.time() < start + self.timeout:
+                        time.sleep(5)
+
+                    else:
+                        print(
+                            f"App {self.middleware_PID} could not connect to {self.middleware_PID}, this whole thing is gonna blow")
+                        quit()
+
             for i, (t, msg) in enumerate(self.messages):
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 time.sleep(t)
-                app_msg = Message(0, 0, f"app:{msg}")
-                start = time.time()
-                while time.time() < start + self.timeout:
-                    try:
-                        # connect this socket to established server
-                        sock.connect(("127.0.0.1", self.middleware_PID))
-                        break
-
-                    except ConnectionRefusedError as e:  # if server is not listening, wait 5 seconds and try again
-                        if time.time() < start + self.timeout:
-                            time.sleep(5)
-
-                        else:
-                            print(
-                                f"App {self.PID} could not connect to {self.middleware_PID}, this whole thing is gonna blow")
-                            quit()
-
+                app_msg = Message(0, 0, msg.encode("utf-8"), APP)
                 sock.sendall(app_msg.encode())
-                sock.close()
+            sock.close()
 
     def _load_config(self, config_file: Path) -> dict:
         # Load config file and return dictionary of process IDs and ports
@@ -260,5 +432,3 @@ if __name__ == "__main__":
     p1.queue.enqueue(m2)
     p1.queue.enqueue(m1)
     print(p1.queue)
-    p1.queue.sort()
-    print(p1.queue)
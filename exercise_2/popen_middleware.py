@@ -5,5 +5,6 @@ import sys
 config_dict = json.loads(sys.argv[1])
 config_idx = config_dict["config_idx"]
 config_path = config_dict["config_path"]
+ordering = config_dict.get("ordering", "lamport")
 
-process = Process(config_idx, config_path)
+process = Process(config_idx, config_path, ordering=ordering)
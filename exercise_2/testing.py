@@ -5,9 +5,9 @@ import json
 from pathlib import Path
 
 
-def main(config_path: Path):
+def main(config_path: Path, ordering: str = "lamport"):
     """
-    Run tests
+    Run tests, the middleware orders messages with the given ordering (see core.ORDERINGS)
     """
     path = config_path.resolve().as_posix()
     with open(path, "r") as f:
@@ -16,7 +16,7 @@ def main(config_path: Path):
 
     for idx, _ in config.items():
         proc = subprocess.Popen(
-            ["python", "popen_middleware.py", json.dumps({"config_idx": idx, "config_path": path})])
+            ["python", "popen_middleware.py", json.dumps({"config_idx": idx, "config_path": path, "ordering": ordering})])
         procs.append(proc)
 
         proc = subprocess.Popen(